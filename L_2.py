@@ -1,85 +1,203 @@
 # -*- coding: utf-8 -*-
 import sys
 import os
-import re
-import tkinter.messagebox as messagebox
+import math
+from array import array
+
+import ust_core
+
+ust_profile = ust_core.load_profile()
+
+# 随长度一起缩放的时间字段（毫秒）：PBS 的起点、PBW 的各段宽度、VBR 的周期、Envelope 的 p1~p5
+# （VBR 的长度、淡入淡出是音符长度的百分比，PreUtterance/VoiceOverlap 是音源的时长，都不变）
+ENVELOPE_TIMES = (0, 1, 2, 8, 9)
+TIME_KEYS = ('PBS=', 'PBW=', 'VBR=', 'Envelope=')
+
+
+def _round(value):
+    """四舍五入（.5 总是进位，结果不受银行家舍入影响）"""
+    return int(math.floor(value + 0.5))
+
+
+def _format(value):
+    if value == int(value):
+        return str(int(value))
+    return '{0:.3f}'.format(value).rstrip('0').rstrip('.')
+
+
+def _scale_fields(fields, indexes, multiplier):
+    """把 fields 中 indexes 位置的数值乘以 multiplier，整数仍写成整数，空值和非数值原样保留"""
+    fields = list(fields)
+    for i in indexes:
+        if i >= len(fields):
+            break
+        text = fields[i].strip()
+        try:
+            value = float(text)
+        except ValueError:
+            continue
+        fields[i] = str(_round(value * multiplier)) if '.' not in text else _format(value * multiplier)
+    return fields
+
+
+def _scale_widths(text, multiplier):
+    """PBW：按累计位置取整（而不是每段各自取整），各点的位置误差不超过 1，不会越往后越偏"""
+    fields = text.split(',')
+    out = []
+    try:
+        if '.' in text:
+            for field in fields:
+                out.append(_format(float(field) * multiplier) if field.strip() else field)
+            return ','.join(out)
+        position = scaled = 0
+        floor = math.floor
+        for field in fields:
+            if not field.strip():
+                out.append(field)
+                continue
+            position += int(field)
+            end = int(floor(position * multiplier + 0.5))
+            out.append(str(end - scaled))
+            scaled = end
+    except ValueError:
+        return text
+    return ','.join(out)
+
+
+def scale_line(line, multiplier):
+    """缩放一行 key=value 中的时间字段，其他行原样返回"""
+    if not line.startswith(TIME_KEYS):
+        return line
+    key, _, value = line.partition('=')
+    if key == 'PBW':
+        return 'PBW=' + _scale_widths(value, multiplier)
+    if key == 'PBS':
+        separator = ';' if ';' in value or ',' not in value else ','
+        return 'PBS=' + separator.join(_scale_fields(value.split(separator), (0,), multiplier))
+    if key == 'VBR':
+        return 'VBR=' + ','.join(_scale_fields(value.split(','), (1,), multiplier))
+    if key == 'Envelope':
+        return 'Envelope=' + ','.join(_scale_fields(value.split(','), ENVELOPE_TIMES, multiplier))
+    return line
+
+
+def multiply_lengths(notes, multiplier, timing=True):
+    """
+    把 NoteTable 中所有音符的长度乘以 multiplier。按累计位置取整：每个音符的结束位置是原结束位置 × multiplier
+    四舍五入，所以总长度正好是原来的 multiplier 倍，几千个音符也不会累积误差（有效音符至少保留 1 tick）。
+    timing 为 True 时同时缩放音高线、颤音周期和包络的时间
+    """
+    lengths = notes.lengths
+    starts = notes.starts
+    scaled = array('i', lengths)
+    scaled_end = 0
+    for row, length in enumerate(lengths):
+        if length > 0:
+            end = max(_round((starts[row] + length) * multiplier), scaled_end + 1)
+            scaled[row] = end - scaled_end
+            scaled_end = end
+        elif length != ust_core.MISSING:
+            scaled[row] = _round(length * multiplier)
+    notes.lengths = scaled
+    notes.update_starts()
+    if timing:
+        # 只重建带时间字段的行；相同的行（如同样的 VBR、Envelope）只解析、缩放一次
+        cache = {}
+        extras = notes.extras
+        for row, old in enumerate(extras):
+            new = []
+            changed = False
+            for line in old:
+                if line.startswith(TIME_KEYS):
+                    scaled_line = cache.get(line)
+                    if scaled_line is None:
+                        scaled_line = cache[line] = scale_line(line, multiplier)
+                    changed = True
+                    line = scaled_line
+                new.append(line)
+            if changed:
+                extras[row] = tuple(new)
+
+
+class SectionScaler(object):
+    """
+    流式处理用：逐节把数字节的长度乘以 multiplier，同样按累计位置取整、缩放时间字段。
+    一首歌用一个 SectionScaler，可直接作为 ust_core.stream_transform 的 transform
+    """
+
+    def __init__(self, multiplier, timing=True):
+        self.multiplier = multiplier
+        self.timing = timing
+        self.end = 0            # 原来的累计位置
+        self.scaled_end = 0     # 缩放后的累计位置
+
+    def __call__(self, section):
+        if section.type != 'number':
+            return section
+        data = section.data
+        try:
+            length = int(data.get('Length'))
+        except (TypeError, ValueError):
+            length = None  # 跳过无效长度
+        if length is not None and length > 0:
+            self.end += length
+            end = max(_round(self.end * self.multiplier), self.scaled_end + 1)
+            data['Length'] = str(end - self.scaled_end)
+            self.scaled_end = end
+        elif length is not None:
+            data['Length'] = str(_round(length * self.multiplier))
+        if self.timing:
+            for key in ('PBS', 'PBW', 'VBR', 'Envelope'):
+                if key in data:
+                    data[key] = scale_line(key + '=' + data[key], self.multiplier)[len(key) + 1:]
+        return section
 
-print('loading...',end='')
 
 class UstProcessor:
     def __init__(self, ust_path, multiplier=2.0):
         self.ust_path = ust_path
         self.multiplier = multiplier
-        self.sections = []
+        self.notes = None
         self._parse_ust()
 
     def _parse_ust(self):
-        current_section = None
         try:
-            with open(self.ust_path, 'r', encoding='shift_jis', errors='ignore') as f:
-                for line in f:
-                    line = line.strip()
-                    if line.startswith('[#'):
-                        current_section = {
-                            'header': line,
-                            'type': self._get_section_type(line),
-                            'data': {},
-                            'original_index': len(self.sections)
-                        }
-                        self.sections.append(current_section)
-                    elif current_section and '=' in line:
-                        try:
-                            key, value = line.split('=', 1)
-                            current_section['data'][key.strip()] = value.strip()
-                        except ValueError:
-                            continue
+            self.notes = ust_core.NoteTable(ust_core.parse_ust(self.ust_path))
         except Exception as e:
-            messagebox.showerror("解析错误", "UST文件解析失败：{0}".format(str(e)))
-
-    def _get_section_type(self, header):
-        match = re.match(r'\[#(\d+|PREV|NEXT)\]', header)
-        if match:
-            return 'number' if match.group(1).isdigit() else match.group(1)
-        return 'other'
+            ust_core.messagebox().showerror("解析错误", "UST文件解析失败：{0}".format(str(e)))
 
     def multiply_lengths(self):
-        for section in self.sections:
-            if section['type'] != 'number':
-                continue
-            length_str = section['data'].get('Length', '0')
-            try:
-                length = int(length_str)
-                new_length = round(length * self.multiplier)  # 四舍五入到整数
-                section['data']['Length'] = str(new_length)
-            except ValueError:
-                continue  # 跳过无效长度
+        multiply_lengths(self.notes, self.multiplier)
 
     def save(self):
         try:
-            with open(self.ust_path, 'w', encoding='shift_jis', newline='\r\n', errors='ignore') as f:
-                for section in self.sections:  # 这里原代码的sections应该是self.sections
-                    f.write(section['header'] + '\r\n')
-                    for k, v in section['data'].items():
-                        f.write('{0}={1}\r\n'.format(k, v))
+            ust_core.write_ust(self.ust_path, self.notes.to_sections(), changed_only=True)
             return True
         except Exception as e:
-            messagebox.showerror("保存错误", "文件保存失败：{0}".format(str(e)))
+            ust_core.messagebox().showerror("保存错误", "文件保存失败：{0}".format(str(e)))
             return False
 
 
 def main():
+    print('loading...',end='')
     if len(sys.argv) < 2:
-        messagebox.showerror("错误", "请通过UTAU插件菜单运行")
+        ust_core.messagebox().showerror("错误", "请通过UTAU插件菜单运行")
         return
     # 倍增因子，用户可手动修改此值
     multiplier = 2.0  # 默认2倍，可手动更改为其他值（如 1.5, 3.0）
     ust_path = sys.argv[-1]
-    processor = UstProcessor(ust_path, multiplier)
-    if not processor.sections:
-        return
-    processor.multiply_lengths()
-    if processor.save():
-        print("音符长度已成功改变！")
+    with ust_profile.session('L_2', ust_path):
+        with ust_profile.phase('parse'):
+            processor = UstProcessor(ust_path, multiplier)
+        if not processor.notes:
+            return
+        ust_profile.note(notes=len(processor.notes))
+        with ust_profile.phase('transform'):
+            processor.multiply_lengths()
+        with ust_profile.phase('save'):
+            saved = processor.save()
+        if saved:
+            print("音符长度已成功改变！")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,808 @@
+# -*- coding: utf-8 -*-
+'''
+性能测试脚本（不需要 UTAU，直接用 python bench_ust.py 运行）
+用法：python bench_ust.py [测试名 ...]，不写测试名则全部运行
+    python bench_ust.py suite --save              各插件处理阶段在 1k/10k/100k 音符上的用时存为基线 bench_baseline.json
+    python bench_ust.py suite --compare           与基线比较，变慢超过 --tolerance（默认 20%）时返回 1
+    python bench_ust.py importtime                各插件冷启动的导入用时，超出 IMPORT_BUDGET_MS 时返回 1
+'''
+import os
+import re
+import sys
+import json
+import time
+import platform
+import argparse
+import random
+import tempfile
+import tracemalloc
+from array import array
+
+import ust_core
+import ust_synth
+import kua_mapping
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+LYRICS = ['a', 'ai', 'ba', 'xiao', 'jiu', 'ni', 'hao', 'R', 'wo', 'de']
+SUITE_SIZES = (1000, 10000, 100000)
+BASELINE_PATH = os.path.join(PLUGIN_DIR, 'bench_baseline.json')
+
+
+def make_ust_text(note_count, seed=0):
+    """生成一个简单的合成 UST 文本（固定的几个拼音，每个音符 3 个音高点）"""
+    return ust_synth.make_ust_text(note_count, seed, lyrics=LYRICS, rest=0.0)
+
+
+def write_temp_ust(note_count, seed=0):
+    fd, path = tempfile.mkstemp(suffix='.ust')
+    with os.fdopen(fd, 'w', encoding='shift_jis', newline='') as f:
+        f.write(make_ust_text(note_count, seed))
+    return path
+
+
+def timeit(func, repeat=5):
+    """返回多次运行中最快的一次（秒）"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def legacy_parse_ust(path):
+    """各插件原来的 _parse_ust 实现（作为对照）"""
+    sections = []
+    current_section = None
+
+    def get_section_type(header):
+        match = re.match(r'\[#(\d+|PREV|NEXT)\]', header)
+        if match:
+            return 'number' if match.group(1).isdigit() else match.group(1)
+        return 'other'
+
+    with open(path, 'r', encoding='shift_jis', errors='ignore') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('[#'):
+                current_section = {
+                    'header': line,
+                    'type': get_section_type(line),
+                    'data': {},
+                    'original_index': len(sections)
+                }
+                sections.append(current_section)
+            elif current_section and '=' in line:
+                try:
+                    key, value = line.split('=', 1)
+                    current_section['data'][key.strip()] = value.strip()
+                except ValueError:
+                    continue
+    return sections
+
+
+def bench_parse(sizes=(1000, 10000)):
+    """解析速度：每 1k 音符耗时"""
+    print('== parse ==')
+    for n in sizes:
+        path = write_temp_ust(n)
+        try:
+            def decode_all():
+                for section in ust_core.parse_ust(path):
+                    section.data
+            old = timeit(lambda: legacy_parse_ust(path))
+            new = timeit(lambda: ust_core.parse_ust(path))
+            full = timeit(decode_all)
+            decoded = timeit(lambda: ust_core.parse_ust(path, decode=True))
+            per_k = 1000.0 / n * 1000
+            print('{0:>7} notes  legacy {1:7.2f} ms/1k  core {2:7.2f} ms/1k  '
+                  'core+decode {3:7.2f} ms/1k  decode=True {4:7.2f} ms/1k'.format(
+                      n, old * per_k, new * per_k, full * per_k, decoded * per_k))
+        finally:
+            os.remove(path)
+
+
+def traced_size(build):
+    """返回 build() 的结果在保留时占用的内存（字节）"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return after - before
+
+
+def bench_notes(n=20000):
+    """列式 NoteTable 与旧的字典列表：内存占用和改长度的耗时"""
+    print('== notes ({0} notes) =='.format(n))
+    path = write_temp_ust(n)
+    try:
+        old_size = traced_size(lambda: legacy_parse_ust(path))
+        new_size = traced_size(lambda: ust_core.NoteTable(ust_core.parse_ust(path)))
+        print('memory   dict sections {0:8.2f} MB  NoteTable {1:8.2f} MB  ({2:.1f}x)'.format(
+            old_size / 1e6, new_size / 1e6, float(old_size) / new_size))
+
+        sections = legacy_parse_ust(path)
+        table = ust_core.NoteTable(ust_core.parse_ust(path))
+
+        def legacy_multiply():
+            for section in sections:
+                if section['type'] != 'number':
+                    continue
+                try:
+                    length = int(section['data'].get('Length', '0'))
+                    section['data']['Length'] = str(round(length * 1.0))
+                except ValueError:
+                    continue
+
+        def table_multiply():
+            table.lengths = array('i', [
+                round(length * 1.0) if length != ust_core.MISSING else length
+                for length in table.lengths
+            ])
+            table.update_starts()
+
+        print('multiply dict sections {0:8.2f} ms  NoteTable {1:8.2f} ms'.format(
+            timeit(legacy_multiply) * 1000, timeit(table_multiply) * 1000))
+    finally:
+        os.remove(path)
+
+
+def bench_mapping():
+    """映射表加载：无缓存（冷启动）与有缓存（热启动）"""
+    import shutil
+    print('== mapping ==')
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for name in ('pinyin.txt', 'pinyin_nao.txt'):
+            path = os.path.join(tmp_dir, name)
+            shutil.copy(os.path.join(PLUGIN_DIR, name), path)
+            cache_path = path + kua_mapping.CACHE_SUFFIX
+
+            def cold():
+                if os.path.exists(cache_path):
+                    os.remove(cache_path)
+                kua_mapping.load_mapping(path)
+            cold_time = timeit(cold)
+            warm_time = timeit(lambda: kua_mapping.load_mapping(path))
+            print('{0:<15} cold {1:7.3f} ms  warm {2:7.3f} ms  ({3:.1f}x)'.format(
+                name, cold_time * 1000, warm_time * 1000, cold_time / warm_time))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def make_lyric_corpus(keys, n, seed=0):
+    """随机歌词：整词、带前缀/后缀、多音节和匹配不上的混在一起"""
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(n):
+        kind = rng.random()
+        if kind < 0.4:
+            lyric = rng.choice(keys)
+        elif kind < 0.55:
+            lyric = '- ' + rng.choice(keys)
+        elif kind < 0.7:
+            lyric = rng.choice(keys) + rng.choice(('_2', '\u2191', '\u2193'))
+        elif kind < 0.9:
+            lyric = ''.join(rng.choice(keys) for _ in range(rng.randint(2, 3)))
+        else:
+            lyric = rng.choice(('R', 'br', '\u3042', 'xx'))
+        corpus.append(lyric)
+    return corpus
+
+
+def bench_matcher(n=200000):
+    """歌词匹配：整词查字典（旧做法）与前缀树匹配（首次匹配/缓存命中）的吞吐量"""
+    print('== matcher ({0} lyrics) =='.format(n))
+    for name in ('pinyin.txt', 'pinyin_nao.txt'):
+        mapping = kua_mapping.load_mapping(os.path.join(PLUGIN_DIR, name))
+        corpus = make_lyric_corpus(sorted(mapping), n)
+        dict_time = timeit(lambda: [mapping.get(lyric) for lyric in corpus], repeat=3)
+        build_time = timeit(lambda: kua_mapping.LyricMatcher(mapping), repeat=3)
+        matcher = kua_mapping.LyricMatcher(mapping)
+        split_time = timeit(lambda: [matcher.split(lyric) for lyric in corpus], repeat=3)
+        cached_time = timeit(lambda: [matcher.options(lyric) for lyric in corpus], repeat=3)
+        old_hits = sum(1 for lyric in corpus if mapping.get(lyric))
+        new_hits = sum(1 for lyric in corpus if matcher.options(lyric))
+        print('{0:<15} build {1:6.2f} ms  dict {2:6.2f} M/s  trie {3:6.2f} M/s  cached {4:6.2f} M/s  '
+              'matched {5:.0%} -> {6:.0%}'.format(
+                  name, build_time * 1000, n / dict_time / 1e6, n / split_time / 1e6, n / cached_time / 1e6,
+                  old_hits / float(n), new_hits / float(n)))
+        # 最坏情况：能一路拆下去、最后一个字符却匹配不上的长歌词，回溯时会反复尝试同一位置
+        for unit, tail in (('en', 'v'), ('ang', '9')):
+            worst = unit * (44 // len(unit)) + tail
+            worst_time = timeit(lambda: matcher.split(worst), repeat=3)
+            print('{0:<15} worst case {1!r} ({2} chars): {3:.3f} ms'.format(
+                '', worst, len(worst), worst_time * 1000))
+
+
+def bench_batch(file_count=48, note_count=3000):
+    """ust_batch 多进程扩展性：1 到 CPU 核数个进程"""
+    import shutil
+    import multiprocessing
+    import ust_batch
+    print('== batch ({0} files x {1} notes) =='.format(file_count, note_count))
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        jobs = []
+        for i in range(file_count):
+            path = os.path.join(tmp_dir, 'in_{0}.ust'.format(i))
+            with open(path, 'w', encoding='shift_jis', newline='') as f:
+                f.write(make_ust_text(note_count, seed=i))
+            jobs.append((path, os.path.join(tmp_dir, 'out_{0}.ust'.format(i))))
+        options = {'mapping': os.path.join(PLUGIN_DIR, 'pinyin.txt'), 'overlap': True,
+                   'pre_utterance': False, 'multiplier': 2.0, 'source': jobs[0][0], 'stream': False}
+        cpu = multiprocessing.cpu_count()
+        workers = sorted(set([1, 2, 4, 8, cpu]))
+        if cpu == 1:
+            print('（本机只有 1 个 CPU，无法测量多进程扩展性）')
+        for operation in ('kua', 'L_2'):
+            base = None
+            for n in workers:
+                if n > cpu:
+                    continue
+                start = time.perf_counter()
+                ust_batch.run_batch(operation, jobs, options, workers=n)
+                elapsed = time.perf_counter() - start
+                base = base or elapsed
+                print('{0:<4} {1:>2} workers {2:7.2f} s  {3:9.0f} notes/s  speedup {4:.2f}x'.format(
+                    operation, n, elapsed, file_count * note_count / elapsed, base / elapsed))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def legacy_start_ticks(sections):
+    """she4 原来的做法：每个音符都把前面所有音符的 Length 重新加一遍"""
+    starts = []
+    for section in sections:
+        if section['type'] != 'number':
+            continue
+        length = int(section['data'].get('Length', '0'))
+        if length <= 0:
+            continue
+        starts.append(sum(int(s['data'].get('Length', '0'))
+                          for s in sections[:section['original_index']] if s['type'] == 'number'))
+    return starts
+
+
+def bench_she4_ticks(sizes=(1000, 10000, 50000)):
+    """she4 写回音高时的起始 tick 计算：逐个求和（旧）与前缀和（新）"""
+    import she4
+    print('== she4 start ticks ==')
+    for n in sizes:
+        path = write_temp_ust(n)
+        try:
+            target = she4.UstProcessor(path)
+            total = target.total_ticks
+            # 空的音高线，只测遍历音符和起始 tick 的开销
+            new = timeit(lambda: target.apply_pitch_and_vibrato_data([], [], total), repeat=3)
+            if n <= 10000:
+                sections = legacy_parse_ust(path)
+                old = timeit(lambda: legacy_start_ticks(sections), repeat=1)
+                old_text = '{0:9.1f} ms'.format(old * 1000)
+            else:
+                old_text = '  (跳过，太慢)'
+            print('{0:>7} notes  legacy {1}  prefix-sum apply {2:8.1f} ms'.format(n, old_text, new * 1000))
+        finally:
+            os.remove(path)
+
+
+def legacy_apply_pitch(target, pitch_timeline, vibrato_data):
+    """she4 以前的做法：每个音符都扫描整条音高线和全部颤音"""
+    notes = target.notes
+    for row, length in enumerate(notes.lengths):
+        if length <= 0:
+            continue
+        start_tick = notes.starts[row]
+        end_tick = start_tick + length
+        new_pbw = []
+        for tick, pitch in pitch_timeline:
+            if start_tick <= tick < end_tick:
+                width = tick - start_tick - sum(float(w) for w in new_pbw if w)
+                if width > 0:
+                    new_pbw.append(str(width))
+        for vbr_start, vbr_end, vbr in vibrato_data:
+            if start_tick < vbr_end and end_tick > vbr_start:
+                break
+
+
+def bench_she4_pitch(sizes=(1000, 3000, 10000, 50000)):
+    """she4 音高映射：线性扫描（旧）与二分索引（新）"""
+    import she4
+    print('== she4 pitch transfer ==')
+    for n in sizes:
+        path = write_temp_ust(n)
+        try:
+            source = she4.UstProcessor(path)
+            pitch_timeline, vibrato_data = source.get_pitch_and_vibrato_data()
+            target = she4.UstProcessor(path)
+            total = target.total_ticks
+            new = timeit(lambda: target.apply_pitch_and_vibrato_data(pitch_timeline, vibrato_data, total), repeat=3)
+            if n <= 3000:
+                old = timeit(lambda: legacy_apply_pitch(target, pitch_timeline, vibrato_data), repeat=1)
+                old_text = '{0:9.1f} ms'.format(old * 1000)
+            else:
+                old_text = '  (跳过，太慢)'
+            print('{0:>7} notes {1:>7} points  legacy {2}  indexed {3:8.1f} ms'.format(
+                n, len(pitch_timeline), old_text, new * 1000))
+        finally:
+            os.remove(path)
+
+
+def bench_pitch_engine(sizes=(1000, 10000, 50000)):
+    """
+    Mode2 音高重采样：纯 Python 与 NumPy 两条路径的耗时，并检查输出一致。
+    插件每次都是新进程，NumPy 这一列加上了冷启动导入 NumPy 的时间；auto 为 resample() 会选的路径
+    """
+    import she4
+    import ust_pitch
+    print('== pitch engine ==')
+    numpy_import = 0.0
+    if ust_pitch.load_numpy() is None:
+        print('（没有安装 NumPy，只测纯 Python）')
+    else:
+        numpy_import = import_time('numpy')[0]
+        print('（导入 NumPy {0:.1f} ms，NUMPY_MIN_POINTS = {1}）'.format(
+            numpy_import * 1000, ust_pitch.NUMPY_MIN_POINTS))
+    for n in sizes:
+        path = write_temp_ust(n)
+        try:
+            source = she4.UstProcessor(path)
+            timeline, _ = source.get_pitch_and_vibrato_data()
+            notes = source.notes
+            rows = [row for row, length in enumerate(notes.lengths) if length > 0]
+            # 错开半拍，让每个音符都切到源曲线的中间
+            starts = [notes.starts[row] + 60 for row in rows]
+            ends = [notes.starts[row] + notes.lengths[row] + 60 for row in rows]
+            python_time = timeit(lambda: ust_pitch._resample_python(timeline, starts, ends), repeat=3)
+            points = len(timeline.ticks)
+            text = '{0:>7} notes {1:>8} points  python {2:8.1f} ms'.format(n, points, python_time * 1000)
+            if ust_pitch.numpy is not None:
+                numpy_time = timeit(lambda: ust_pitch._resample_numpy(timeline, starts, ends), repeat=3)
+                same = (ust_pitch._resample_python(timeline, starts, ends) ==
+                        ust_pitch._resample_numpy(timeline, starts, ends))
+                # 这里 NumPy 已经导入，按插件的新进程判断：只看点数
+                auto = 'numpy' if points >= ust_pitch.NUMPY_MIN_POINTS else 'python'
+                text += '  numpy+import {0:8.1f} ms  auto {1:<6}  output identical: {2}'.format(
+                    (numpy_time + numpy_import) * 1000, auto, same)
+            print(text)
+        finally:
+            os.remove(path)
+
+
+# 子进程的峰值内存取 /proc/self/status 的 VmHWM：它在 exec 时清零。
+# ru_maxrss 会经 fork/exec 继承父进程的峰值（父进程刚生成过整个测试文件），测出来的是父进程的值
+_RSS_SCRIPT = """
+import sys
+sys.path.insert(0, {plugin_dir!r})
+import ust_core, kua_mapping, L_2
+mode, operation, in_path, out_path = sys.argv[1:5]
+mapping = kua_mapping.load_mapping({mapping!r}, use_cache=False)
+if mode == 'stream':
+    if operation == 'kua':
+        transform = kua_mapping.ProjectSplitter(mapping)
+    else:
+        transform = L_2.SectionScaler(2.0)
+    ust_core.stream_transform(in_path, out_path, transform)
+else:
+    sections = ust_core.parse_ust(in_path)
+    if operation == 'kua':
+        sections = kua_mapping.split_project(sections, mapping)[0]
+    else:
+        scaler = L_2.SectionScaler(2.0)
+        sections = [scaler(section) for section in sections]
+    ust_core.write_ust(out_path, sections)
+print()
+with open('/proc/self/status') as f:
+    print([line.split()[1] for line in f if line.startswith('VmHWM:')][0])
+"""
+
+
+def bench_stream(n=100000):
+    """流式读写与整文件读写的峰值内存（子进程的 VmHWM）"""
+    import subprocess
+    if not os.path.exists('/proc/self/status'):
+        print('== stream == （本系统没有 /proc/self/status，跳过）')
+        return
+    print('== stream ({0} notes) =='.format(n))
+    path = write_temp_ust(n)
+    out_path = path + '.out'
+    script = _RSS_SCRIPT.format(plugin_dir=PLUGIN_DIR, mapping=os.path.join(PLUGIN_DIR, 'pinyin.txt'))
+    try:
+        for operation in ('L_2', 'kua'):
+            result = {}
+            for mode in ('full', 'stream'):
+                start = time.perf_counter()
+                output = subprocess.check_output([sys.executable, '-c', script, mode, operation, path, out_path])
+                elapsed = time.perf_counter() - start
+                result[mode] = (int(output.split()[-1]) / 1024.0, elapsed)  # VmHWM 的单位是 KB
+            print('{0:<4} full {1:7.1f} MB {2:5.2f} s   stream {3:7.1f} MB {4:5.2f} s'.format(
+                operation, result['full'][0], result['full'][1], result['stream'][0], result['stream'][1]))
+    finally:
+        os.remove(path)
+        if os.path.exists(out_path):
+            os.remove(out_path)
+
+
+def bench_write(n=20000, changed_every=20):
+    """插件写回：全部写出与只写改动（每 changed_every 个音符改一个）的大小和用时"""
+    print('== write ({0} notes, 1/{1} changed) =='.format(n, changed_every))
+    path = write_temp_ust(n)
+    out_path = path + '.out'
+    try:
+        notes = ust_core.NoteTable(ust_core.parse_ust(path))
+        for row in range(0, len(notes), changed_every):
+            notes.set(row, 'Lyric', 'changed')
+        for changed_only in (False, True):
+            elapsed = timeit(lambda: ust_core.write_ust(out_path, notes.to_sections(), changed_only=changed_only))
+            print('{0:<12} {1:8.1f} KB {2:7.2f} ms'.format(
+                'changed_only' if changed_only else 'full', os.path.getsize(out_path) / 1024.0, elapsed * 1000))
+    finally:
+        os.remove(path)
+        if os.path.exists(out_path):
+            os.remove(out_path)
+
+
+def legacy_note_at_seconds(sections, seconds):
+    """逐个音符累加秒数查找（旧写法，每次 O(n)）"""
+    tempo = 120.0
+    elapsed = 0.0
+    row = 0
+    for section in sections:
+        tempo = float(section.get('Tempo') or tempo)
+        if section.type != 'number':
+            continue
+        length = int(section.get('Length', '0')) * 60.0 / (tempo * 480)
+        if elapsed + length > seconds:
+            return row
+        elapsed += length
+        row += 1
+    return None
+
+
+def bench_timeline(n=50000, tempo_every=100, lookups=2000):
+    """时间轴：建立用时，按秒找音符（二分）与逐个累加的对比"""
+    print('== timeline ({0} notes, tempo change every {1}) =='.format(n, tempo_every))
+    sections = ust_core.parse_lines(make_ust_text(n).split('\r\n'))
+    notes = [section for section in sections if section.type == 'number']
+    for row in range(0, n, tempo_every):
+        notes[row].data['Tempo'] = str(90 + row // tempo_every % 60)
+    table = ust_core.NoteTable(sections)
+    build = timeit(table.timeline)
+    timeline = table.timeline()
+    rnd = random.Random(0)
+    total = timeline.seconds(timeline.total_ticks())
+    points = [rnd.uniform(0, total) for _ in range(lookups)]
+    fast = timeit(lambda: [timeline.note_at_seconds(p) for p in points])
+    slow = timeit(lambda: [legacy_note_at_seconds(sections, p) for p in points[:20]], repeat=1) * lookups / 20
+    assert all(timeline.note_at_seconds(p) == legacy_note_at_seconds(sections, p) for p in points[:20])
+    print('build {0:7.2f} ms   {1} lookups: bisect {2:7.2f} ms   linear {3:9.1f} ms (est.)'.format(
+        build * 1000, lookups, fast * 1000, slow * 1000))
+
+
+def _first_paint(build):
+    """build() 建好界面并返回根窗口，处理完所有待绘制事件后返回 (用时, 根窗口)"""
+    start = time.perf_counter()
+    root = build()
+    root.update()
+    return time.perf_counter() - start, root
+
+
+def bench_gui(sizes=(1000, 10000, 50000)):
+    """界面打开到第一次绘制完成的时间：逐行插入所有音符（旧做法）与虚拟表格"""
+    import tkinter as tk
+    from tkinter import ttk
+    try:
+        tk.Tk().destroy()
+    except tk.TclError:
+        print('== gui == （没有可用的显示器，跳过）')
+        return
+    import show_5
+    import kua_3_fix
+
+    class Processor(object):
+        def __init__(self, path):
+            self.ust_path = path
+            self.sections = ust_core.parse_ust(path)
+
+    mapping = kua_mapping.load_mapping(os.path.join(PLUGIN_DIR, 'pinyin.txt'))
+    print('== gui (time to first paint) ==')
+    for n in sizes:
+        path = write_temp_ust(n)
+        try:
+            parser = show_5.UstNoteParser(path)
+            parser.parse()
+            processor = Processor(path)
+
+            def legacy():
+                root = tk.Tk()
+                tree = ttk.Treeview(root, columns=('type', 'lyric', 'options'), show='headings')
+                tree.pack(fill='both', expand=True)
+                for section in processor.sections:
+                    tree.insert('', 'end', values=('可替换', section.get('Lyric', ''), '--'))
+                return root
+
+            def viewer():
+                return show_5.NoteViewer(parser.notes, parser.tempo).root
+
+            def mapper():
+                kua_3_fix._import_tkinter()
+                root = tk.Tk()
+                kua_3_fix.MappingInterface(root, processor, mapping)
+                return root
+
+            result = []
+            for build in (legacy, viewer, mapper):
+                elapsed, root = _first_paint(build)
+                root.destroy()
+                result.append(elapsed * 1000)
+            print('{0:6d} notes  legacy insert {1:8.1f} ms  show_5 {2:6.1f} ms  kua_3_fix {3:6.1f} ms'.format(
+                n, *result))
+        finally:
+            os.remove(path)
+
+
+def timeit_setup(setup, func, repeat=3):
+    """每次先运行 setup()（不计时），再对 func(setup 的结果) 计时，返回最快的一次（秒）"""
+    best = None
+    for _ in range(repeat):
+        value = setup()
+        start = time.perf_counter()
+        func(value)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def suite_stages(path, mapping):
+    """
+    各插件的处理阶段：[(名称, setup, func)]，都不需要界面。
+    kua_apply 对应 MappingInterface._apply_changes（每个能匹配的音都用第一个方案）
+    """
+    import jun
+    import L_2
+    import she4
+    import show_5
+    import kua_3_fix
+
+    def load_sections():
+        return ust_core.parse_ust(path)
+
+    def load_notes():
+        return ust_core.NoteTable(ust_core.parse_ust(path))
+
+    def load_she4():
+        processor = she4.UstProcessor(path, parse=False)
+        processor.load()
+        return processor
+
+    def load_pitch():
+        processor = load_she4()
+        return processor, processor.get_pitch_and_vibrato_data()
+
+    def selections(sections):
+        matcher = kua_mapping.LyricMatcher(mapping)
+        chosen = {}
+        for idx, section in enumerate(sections):
+            if section.type == 'number':
+                options = matcher.options(section.get('Lyric', ''))
+                if options:
+                    chosen[idx] = options[0]
+        return sections, chosen
+
+    def apply_pitch(value):
+        processor, (pitch_timeline, vibrato_data) = value
+        processor.apply_pitch_and_vibrato_data(pitch_timeline, vibrato_data, processor.total_ticks)
+
+    return [
+        ('kua_parse', lambda: kua_3_fix.UstProcessor(path, parse=False), lambda p: p.load()),
+        ('kua_apply', lambda: selections(load_sections()),
+         lambda value: kua_mapping.replace_notes(value[0], value[1])),
+        ('L_2_multiply', load_notes, lambda notes: L_2.multiply_lengths(notes, 1.5)),
+        ('jun_average', load_notes, jun.average_lengths),
+        ('jun_phrases', load_notes, lambda notes: jun.average_phrases(notes, 60)),
+        ('she4_parse', lambda: she4.UstProcessor(path, parse=False), lambda p: p.load()),
+        ('she4_extract', load_she4, lambda p: p.get_pitch_and_vibrato_data()),
+        ('she4_apply', load_pitch, apply_pitch),
+        ('show5_parse', lambda: show_5.UstNoteParser(path), lambda p: p.load()),
+        ('write', load_notes, lambda notes: ust_core.write_ust(path + '.out', notes.to_sections())),
+    ]
+
+
+def run_suite(sizes=SUITE_SIZES, repeat=3, seed=0):
+    """
+    在合成 UST（pinyin.txt 的拼音、Mode2 音高、两成颤音、每 200 个音符变速）上给各阶段计时，
+    返回可写成 JSON 的结果 {'results': {阶段: {音符数: 秒}}, ...}
+    """
+    mapping = kua_mapping.load_mapping(os.path.join(PLUGIN_DIR, 'pinyin.txt'))
+    lyrics = sorted(mapping)
+    results = {}
+    for n in sizes:
+        fd, path = tempfile.mkstemp(suffix='.ust')
+        os.close(fd)
+        ust_synth.write_ust(path, n, seed, lyrics=lyrics, vibrato=0.2, tempo_every=200)
+        try:
+            for name, setup, func in suite_stages(path, mapping):
+                elapsed = timeit_setup(setup, func, repeat)
+                results.setdefault(name, {})[str(n)] = elapsed
+                print('{0:<14} {1:>7} notes {2:9.2f} ms'.format(name, n, elapsed * 1000))
+        finally:
+            for p in (path, path + '.out'):
+                if os.path.exists(p):
+                    os.remove(p)
+    return {
+        'version': 1,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': seed,
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def compare_suite(baseline, current, tolerance=0.2):
+    """与基线比较，返回变慢超过 tolerance（比例）的 [(阶段, 音符数, 基线秒, 当前秒)]"""
+    regressions = []
+    for name, by_size in sorted(current['results'].items()):
+        for size, elapsed in sorted(by_size.items(), key=lambda item: int(item[0])):
+            old = baseline.get('results', {}).get(name, {}).get(size)
+            if old is None:
+                continue
+            ratio = elapsed / old if old else float('inf')
+            flag = ''
+            if ratio > 1 + tolerance:
+                flag = '  <-- 变慢'
+                regressions.append((name, int(size), old, elapsed))
+            print('{0:<14} {1:>7} notes {2:9.2f} -> {3:9.2f} ms  x{4:.2f}{5}'.format(
+                name, size, old * 1000, elapsed * 1000, ratio, flag))
+    return regressions
+
+
+def bench_suite(sizes=SUITE_SIZES, repeat=3, save=None, compare=None, tolerance=0.2):
+    """各插件处理阶段的计时，可保存为基线 JSON 或与基线比较（有变慢时返回 False）"""
+    print('== suite ({0} notes) =='.format(', '.join(str(n) for n in sizes)))
+    current = run_suite(sizes, repeat)
+    if save:
+        with open(save, 'w', encoding='utf-8') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+        print('基线已保存到 {0}'.format(save))
+    if compare:
+        with open(compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        print('-- 与 {0} 比较（允许慢 {1:.0%}） --'.format(compare, tolerance))
+        regressions = compare_suite(baseline, current, tolerance)
+        if regressions:
+            print('{0} 项变慢'.format(len(regressions)))
+            return False
+    return True
+
+
+# 各插件冷启动（import）用时上限（毫秒）；L_2/jun 不开窗口，不能导入 tkinter
+IMPORT_BUDGET_MS = {
+    'L_2': 25,
+    'jun': 25,
+    'show_5': 60,
+    'kua_3_fix': 60,
+    'she4': 60,
+}
+NO_TKINTER = ('L_2', 'jun', 'kua_3_fix', 'she4')  # kua_3_fix、she4 打开窗口时才导入 tkinter
+
+# 模拟没有 _tkinter 的 Python：无界面的批量路径都要能运行
+_HEADLESS_SCRIPT = """
+import sys
+sys.modules['tkinter'] = sys.modules['_tkinter'] = None
+sys.path.insert(0, {plugin_dir!r})
+import kua_3_fix, ust_batch
+in_path, out_dir = sys.argv[1:3]
+status = kua_3_fix.batch_main(['-o', out_dir, in_path])
+status |= ust_batch.main(['she4', '-j', '1', '--source', in_path, '-o', out_dir, in_path])
+sys.exit(status)
+"""
+
+
+def import_time(module, repeat=5):
+    """python -X importtime 测得的导入用时（秒，取最快一次）和是否导入了 tkinter"""
+    import subprocess
+    best = None
+    uses_tkinter = False
+    for _ in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, '-X', 'importtime', '-c', 'import {0}'.format(module)],
+            cwd=PLUGIN_DIR, stderr=subprocess.STDOUT).decode('utf-8', 'replace')
+        for line in output.splitlines():
+            fields = [field.strip() for field in line.split('|')]
+            if len(fields) != 3:
+                continue
+            if fields[2] == 'tkinter':
+                uses_tkinter = True
+            if fields[2] == module:
+                elapsed = int(fields[1]) / 1e6
+                best = elapsed if best is None else min(best, elapsed)
+    return best, uses_tkinter
+
+
+def bench_importtime(budgets=None):
+    """各插件的导入用时与预算比较，超出预算或不该导入 tkinter 却导入了时返回 False"""
+    budgets = budgets or IMPORT_BUDGET_MS
+    print('== importtime ==')
+    ok = True
+    for module in sorted(budgets):
+        elapsed, uses_tkinter = import_time(module)
+        problems = []
+        if elapsed * 1000 > budgets[module]:
+            problems.append('超出预算')
+        if uses_tkinter and module in NO_TKINTER:
+            problems.append('导入了 tkinter')
+        ok = ok and not problems
+        print('{0:<10} {1:7.1f} ms  (budget {2} ms, tkinter {3}){4}'.format(
+            module, elapsed * 1000, budgets[module], 'yes' if uses_tkinter else 'no',
+            '  <-- ' + '，'.join(problems) if problems else ''))
+    return check_headless() and ok
+
+
+def check_headless():
+    """在没有 tkinter 的情况下运行 kua_3_fix --batch 和 ust_batch she4，都成功时返回 True"""
+    import shutil
+    import subprocess
+    path = write_temp_ust(50)
+    out_dir = tempfile.mkdtemp()
+    try:
+        status = subprocess.call([sys.executable, '-c', _HEADLESS_SCRIPT.format(plugin_dir=PLUGIN_DIR), path, out_dir],
+                                 stdout=subprocess.DEVNULL)
+    finally:
+        os.remove(path)
+        shutil.rmtree(out_dir)
+    print('{0:<10} {1}'.format('headless', 'ok' if status == 0 else '失败（批量路径需要 tkinter？）  <--'))
+    return status == 0
+
+
+BENCHMARKS = {
+    'parse': bench_parse,
+    'notes': bench_notes,
+    'mapping': bench_mapping,
+    'matcher': bench_matcher,
+    'batch': bench_batch,
+    'she4_ticks': bench_she4_ticks,
+    'she4_pitch': bench_she4_pitch,
+    'pitch_engine': bench_pitch_engine,
+    'stream': bench_stream,
+    'write': bench_write,
+    'timeline': bench_timeline,
+    'gui': bench_gui,
+    'suite': bench_suite,
+    'importtime': bench_importtime,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='UST 插件性能测试')
+    parser.add_argument('names', nargs='*', help='测试名，不写则全部运行（可用：{0}）'.format(
+        ', '.join(sorted(BENCHMARKS))))
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SUITE_SIZES), help='suite：音符数')
+    parser.add_argument('--repeat', type=int, default=3, help='suite：每项重复次数（取最快）')
+    parser.add_argument('--save', nargs='?', const=BASELINE_PATH,
+                        help='suite：把结果保存为基线 JSON（默认 bench_baseline.json）')
+    parser.add_argument('--compare', nargs='?', const=BASELINE_PATH, help='suite：与基线 JSON 比较，变慢时返回 1')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='suite：允许变慢的比例')
+    args = parser.parse_args(argv)
+    ok = True
+    for name in args.names or sorted(BENCHMARKS):
+        if name not in BENCHMARKS:
+            print('未知测试：{0}（可用：{1}）'.format(name, ', '.join(sorted(BENCHMARKS))))
+            continue
+        if name == 'suite':
+            result = bench_suite(args.sizes, args.repeat, args.save, args.compare, args.tolerance)
+        else:
+            result = BENCHMARKS[name]()
+        if result is False:
+            ok = False
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
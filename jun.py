@@ -1,94 +1,134 @@
 # -*- coding: utf-8 -*-
 import sys
 import os
-import re
-import tkinter.messagebox as messagebox
+from array import array
+
+import ust_core
+
+ust_profile = ust_core.load_profile()
+
+
+def average_lengths(notes):
+    """把 NoteTable 中所有音符的长度统一为平均值，没有有效长度时返回 False"""
+    # 收集所有数字节的有效长度
+    lengths = [length for length in notes.lengths if length > 0]
+    if not lengths:
+        return False
+    # 计算平均长度并四舍五入
+    average_length = round(sum(lengths) / len(lengths))  # 四舍五入到整数
+    # 写回平均长度到所有数字节
+    notes.lengths = array('i', [average_length]) * len(notes)
+    notes.update_starts()
+    return True
+
+
+def _phrase_bounds(start, total, count, grid):
+    """
+    一句中 count 个音符平分 total tick 时各音符的结束位置（从 start 算起的绝对位置）。
+    按累计位置四舍五入，余数均匀分给各音符；grid 大于 0 且句子够长时，音符之间的分界对齐到 grid 的整数倍，
+    最后一个音符的结束位置始终是句尾，句子总长不变
+    """
+    if grid and total >= grid * count:
+        # round((start + i * total / count) / grid) * grid，全用整数算
+        bounds = [(2 * (start * count + i * total) + grid * count) // (2 * grid * count) * grid
+                  for i in range(1, count)]
+    else:
+        bounds = [start + (2 * i * total + count) // (2 * count) for i in range(1, count)]
+    bounds.append(start + total)
+    return bounds
+
+
+def average_phrases(notes, grid=0):
+    """
+    按休止符（R）把音符分成乐句，每句内的音符平分这一句的总长度，句子总长和休止符都不变，
+    整首歌的总长度也不变。grid 为量化网格（tick，0 为不量化）。没有要平均的音符时返回 False
+    """
+    lengths = notes.lengths
+    starts = notes.starts
+    scaled = array('i', lengths)
+    rests = set(notes.matching_rows('Lyric', ust_core.is_rest))
+    phrases = []
+    phrase = []  # 当前乐句中有效音符的行号
+    for row, length in enumerate(lengths):
+        if length <= 0:
+            continue  # 无效或长度为 0 的音符不占时间，也不断句
+        if row in rests:
+            if phrase:
+                phrases.append(phrase)
+                phrase = []
+        else:
+            phrase.append(row)
+    if phrase:
+        phrases.append(phrase)
+    if not phrases:
+        return False
+    for phrase in phrases:
+        start = starts[phrase[0]]
+        end = starts[phrase[-1]] + lengths[phrase[-1]]
+        previous = start
+        for row, bound in zip(phrase, _phrase_bounds(start, end - start, len(phrase), grid)):
+            scaled[row] = bound - previous
+            previous = bound
+    notes.lengths = scaled
+    notes.update_starts()
+    return True
 
 
 class UstProcessor:
-    def __init__(self, ust_path):
+    def __init__(self, ust_path, phrases=True, grid=0):
         self.ust_path = ust_path
-        self.sections = []
+        self.phrases = phrases
+        self.grid = grid
+        self.notes = None
         self._parse_ust()
 
     def _parse_ust(self):
-        current_section = None
         try:
-            with open(self.ust_path, 'r', encoding='shift_jis', errors='ignore') as f:
-                for line in f:
-                    line = line.strip()
-                    if line.startswith('[#'):
-                        current_section = {
-                            'header': line,
-                            'type': self._get_section_type(line),
-                            'data': {},
-                            'original_index': len(self.sections)
-                        }
-                        self.sections.append(current_section)
-                    elif current_section and '=' in line:
-                        try:
-                            key, value = line.split('=', 1)
-                            current_section['data'][key.strip()] = value.strip()
-                        except ValueError:
-                            continue
+            self.notes = ust_core.NoteTable(ust_core.parse_ust(self.ust_path))
         except Exception as e:
-            messagebox.showerror("解析错误", "UST文件解析失败：{0}".format(str(e)))
-
-    def _get_section_type(self, header):
-        match = re.match(r'\[#(\d+|PREV|NEXT)\]', header)
-        if match:
-            return 'number' if match.group(1).isdigit() else match.group(1)
-        return 'other'
+            ust_core.messagebox().showerror("解析错误", "UST文件解析失败：{0}".format(str(e)))
 
     def average_lengths(self):
-        # 收集所有数字节的长度
-        lengths = []
-        for section in self.sections:
-            if section['type'] != 'number':
-                continue
-            length_str = section['data'].get('Length', '0')
-            try:
-                length = int(length_str)
-                if length > 0:
-                    lengths.append(length)
-            except ValueError:
-                continue
-        # 计算平均长度并四舍五入
-        if not lengths:
-            messagebox.showwarning("警告", "没有有效的数字节长度")
+        if self.phrases:
+            averaged = average_phrases(self.notes, self.grid)
+        else:
+            averaged = average_lengths(self.notes)
+        if not averaged:
+            ust_core.messagebox().showwarning("警告", "没有有效的数字节长度")
             return False
-        average_length = round(sum(lengths) / len(lengths))  # 四舍五入到整数
-        # 写回平均长度到所有数字节
-        for section in self.sections:
-            if section['type'] != 'number':
-                continue
-            section['data']['Length'] = str(average_length)
         return True
 
     def save(self):
         try:
-            with open(self.ust_path, 'w', encoding='shift_jis', newline='\r\n', errors='ignore') as f:
-                for section in self.sections:
-                    f.write(section['header'] + '\r\n')
-                    for k, v in section['data'].items():
-                        f.write('{0}={1}\r\n'.format(k, v))
+            ust_core.write_ust(self.ust_path, self.notes.to_sections(), changed_only=True)
             return True
         except Exception as e:
-            messagebox.showerror("保存错误", "文件保存失败：{0}".format(str(e)))
+            ust_core.messagebox().showerror("保存错误", "文件保存失败：{0}".format(str(e)))
             return False
 
 
 def main():
     if len(sys.argv) < 2:
-        messagebox.showerror("错误", "请通过UTAU插件菜单运行")
+        ust_core.messagebox().showerror("错误", "请通过UTAU插件菜单运行")
         return
+    # 按休止符（R）分句，每句内平均且句子总长不变；改为 False 则所有音符统一为全局平均值（旧做法）
+    phrases = True
+    # 量化网格（tick），如 60、120；0 为不量化
+    grid = 0
     ust_path = sys.argv[-1]
-    processor = UstProcessor(ust_path)
-    if not processor.sections:
-        return
-    if processor.average_lengths():
-        if processor.save():
-            print("音符长度已统一为平均值！")
+    with ust_profile.session('jun', ust_path):
+        with ust_profile.phase('parse'):
+            processor = UstProcessor(ust_path, phrases, grid)
+        if not processor.notes:
+            return
+        ust_profile.note(notes=len(processor.notes))
+        with ust_profile.phase('transform'):
+            averaged = processor.average_lengths()
+        if averaged:
+            with ust_profile.phase('save'):
+                saved = processor.save()
+            if saved:
+                print("音符长度已统一为平均值！")
 
 
 if __name__ == "__main__":
@@ -7,11 +7,13 @@ print("loading...",end="")
 
 import sys 
 import os 
-import re 
 import tkinter as tk 
 import tkinter.messagebox as messagebox 
 from tkinter import ttk 
 
+import ust_core
+import kua_mapping
+
 PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
 
 class MappingManager:
@@ -20,41 +22,11 @@ class MappingManager:
 
     def _load_mapping(self):
         mapping_path = os.path.join(PLUGIN_DIR, "pinyin.txt")
-        mapping = {}
         try:
-            with open(mapping_path, 'r', encoding='utf-8') as f:
-                for line in f:
-                    line = line.strip()
-                    if not line or line.startswith('#') or ';' not in line:
-                        continue
-                    try:
-                        pinyin, romaji = line.split(';', 1)
-                        options = [opt.split(',') for opt in romaji.split('_') if opt]
-                        formatted_options = []
-                        for opt in options:
-                            formatted_opt = []
-                            for part in opt:
-                                if '.' in part:
-                                    try:
-                                        ratio, roma = part.split('.', 1)
-                                        ratio = int(ratio)
-                                        if ratio <= 0:
-                                            continue
-                                        formatted_opt.append((ratio, roma.strip()))
-                                    except (ValueError, IndexError):
-                                        continue
-                                else:
-                                    continue
-                            if formatted_opt:
-                                formatted_options.append(formatted_opt)
-                        if formatted_options:
-                            mapping[pinyin.strip()] = formatted_options
-                    except Exception:
-                        continue
+            return kua_mapping.load_mapping(mapping_path)
         except Exception as e:
             messagebox.showerror("映射表错误", "加载失败：{0}".format(str(e)))
             return None
-        return mapping
 
 class UstProcessor:
     def __init__(self, ust_path):
@@ -63,52 +35,26 @@ class UstProcessor:
         self._parse_ust()
 
     def _parse_ust(self):
-        current_section = None
         try:
-            with open(self.ust_path, 'r', encoding='shift_jis', errors='ignore') as f:
-                for line in f:
-                    line = line.strip()
-                    if line.startswith('[#'):
-                        current_section = {
-                            'header': line,
-                            'type': self._get_section_type(line),
-                            'data': {},
-                            'original_index': len(self.sections)
-                        }
-                        self.sections.append(current_section)
-                    elif current_section and '=' in line:
-                        try:
-                            key, value = line.split('=', 1)
-                            current_section['data'][key.strip()] = value.strip()
-                        except ValueError:
-                            continue
+            self.sections = ust_core.parse_ust(self.ust_path)
         except Exception as e:
             messagebox.showerror("解析错误", "UST 文件解析失败：{0}".format(str(e)))
 
-    def _get_section_type(self, header):
-        match = re.match(r'\[#(\d+|PREV|NEXT)\]', header)
-        if match:
-            return 'number' if match.group(1).isdigit() else match.group(1)
-        return 'other'
-
     def save(self, sections):
         try:
-            with open(self.ust_path, 'w', encoding='shift_jis', newline='\r\n', errors='ignore') as f:
-                for section in sections:
-                    f.write(section['header'] + '\r\n')
-                    for k, v in section['data'].items():
-                        f.write('{0}={1}\r\n'.format(k, v))
+            ust_core.write_ust(self.ust_path, sections, changed_only=True)
             return True
         except Exception as e:
             messagebox.showerror("保存错误", "文件保存失败：{0}".format(str(e)))
             return False
 
 class MappingInterface:
-    def __init__(self, master, sections, mapping, ust_path):
+    def __init__(self, master, processor, mapping):
         self.master = master
-        self.original_sections = sections
+        self.processor = processor
+        self.original_sections = processor.sections
         self.mapping = mapping
-        self.ust_path = ust_path
+        self.ust_path = processor.ust_path
         self.modified_sections = []
         self.selections = {}
         self.current_combobox = None
@@ -156,10 +102,10 @@ class MappingInterface:
 
     def _populate_tree(self):
         for idx, section in enumerate(self.original_sections):
-            if section['type'] != 'number':
+            if section.type != 'number':
                 self._add_uneditable_row(section)
                 continue
-            lyric = section['data'].get('Lyric', '')
+            lyric = section.get('Lyric', '')
             if lyric in self.mapping and len(self.mapping[lyric]) > 0:
                 options = self.mapping[lyric]
                 default_option = ', '.join(roma for _, roma in options[0])
@@ -175,9 +121,10 @@ class MappingInterface:
         display_type = {
             'PREV': '前导音符',
             'NEXT': '后续音符',
+            'SETTING': '设置',
             'other': '其他'
-        }.get(section['type'], '特殊')
-        lyric = section['data'].get('Lyric', section['type'])
+        }.get(section.type, '特殊')
+        lyric = section.get('Lyric', section.type)
         self.tree.insert('', 'end', values=(display_type, lyric, '（不可修改）'), tags=('uneditable',))
 
     def _on_double_click(self, event):
@@ -231,9 +178,9 @@ class MappingInterface:
         self.current_combobox = None
 
     def _apply_changes(self):
-        new_sections = []
+        new_sections = ust_core.SectionList(encoding=self.original_sections.encoding)
         for idx, section in enumerate(self.original_sections):
-            if section['type'] != 'number':
+            if section.type != 'number':
                 new_sections.append(section)
                 continue
             if idx not in self.selections:
@@ -245,40 +192,35 @@ class MappingInterface:
             new_notes = self._generate_new_notes(original_note, romaji_list)
             new_sections.extend(new_notes)
 
-        new_sections.append({
-            'header': '[#DELETE]',
-            'type': 'number',
-            'data': {}
-        })
+        new_sections.append(ust_core.UstSection('[#DELETE]', 'number', data={}))
 
-        if UstProcessor(self.ust_path).save(new_sections):
+        if self.processor.save(new_sections):
             messagebox.showinfo("完成", "替换操作已完成")
             self.master.destroy()
 
     def _generate_new_notes(self, original_note, romaji_list):
         new_notes = []
-        total_length = int(original_note['data'].get('Length', 480))
-        total_ratio = sum(ratio for ratio, _ in romaji_list) or 10
+        total_length = int(original_note.get('Length', 480))
+        lengths = kua_mapping.split_lengths(tuple(ratio for ratio, _ in romaji_list), total_length)
 
-        for i, (ratio, roma_sound) in enumerate(romaji_list):
-            note_length = int(total_length * ratio / total_ratio)
+        for i, (_, roma_sound) in enumerate(romaji_list):
+            note_length = lengths[i]
             if note_length <= 0:
                 continue
 
-            new_note = {
-                'header': '[#INSERT]',
-                'type': 'number',
-                'data': {
+            new_note = ust_core.UstSection(
+                '[#INSERT]', 'number',
+                data={
                     'Lyric': roma_sound,
                     'Length': str(note_length),
-                    'NoteNum': original_note['data'].get('NoteNum', '60'),
+                    'NoteNum': original_note.data.get('NoteNum', '60'),
                     'PreUtterance': '0' if self.pre_utterance_var.get() else '',
                     'VoiceOverlap': '80' if self.overlap_var.get() and i > 0 else '0'
                 }
-            }
+            )
             # 如果原始音符有 Tempo，且当前是第一个音符，添加 Tempo
-            if i == 0 and 'Tempo' in original_note['data']:
-                new_note['data']['Tempo'] = original_note['data']['Tempo']
+            if i == 0 and 'Tempo' in original_note.data:
+                new_note.data['Tempo'] = original_note.data['Tempo']
             new_notes.append(new_note)
 
         return new_notes
@@ -298,7 +240,7 @@ def main():
         return
 
     root = tk.Tk()
-    MappingInterface(root, processor.sections, mapper.mapping, ust_path)
+    MappingInterface(root, processor, mapper.mapping)
     root.mainloop()
 
 if __name__ == "__main__":
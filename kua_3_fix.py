@@ -6,12 +6,29 @@ print("loading...",end="")
 
 import sys
 import os
-import re
-import tkinter as tk
-import tkinter.messagebox as messagebox
-from tkinter import ttk
+
+import ust_core
+import ust_oto
+import kua_mapping
+
+ust_profile = ust_core.load_profile()
+
+tk = ttk = messagebox = ust_gui = None  # 界面用的模块，由 _import_tkinter() 导入
+
+
+def _import_tkinter():
+    """打开窗口前才导入 tkinter 和 ust_gui：--batch 不需要界面，没有 tkinter 的 Python 也能批量拆音"""
+    global tk, ttk, messagebox, ust_gui
+    import tkinter as tk
+    import tkinter.messagebox as messagebox
+    from tkinter import ttk
+    import ust_gui
+
 
 PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+MEMORY_PATH = os.path.join(PLUGIN_DIR, "kua_choices.json")  # 记住每个工程选过的方案
+ALIAS_PATH = os.path.join(PLUGIN_DIR, "aaaaa.txt")           # 连续音模式的别名表
+POPULATE_BATCH = 500  # 表格每批填充的行数
 
 class MappingManager:
     def __init__(self):
@@ -19,97 +36,46 @@ class MappingManager:
 
     def _load_mapping(self):
         mapping_path = os.path.join(PLUGIN_DIR, "pinyin.txt")
-        mapping = {}
         try:
-            with open(mapping_path, 'r', encoding='utf-8') as f:
-                for line in f:
-                    line = line.strip()
-                    if not line or line.startswith('#') or ';' not in line:
-                        continue
-                    try:
-                        pinyin, romaji = line.split(';', 1)
-                        options = [opt.split(',') for opt in romaji.split('_') if opt]
-                        formatted_options = []
-                        for opt in options:
-                            formatted_opt = []
-                            for part in opt:
-                                if '.' in part:
-                                    try:
-                                        ratio, roma = part.split('.', 1)
-                                        ratio = int(ratio)
-                                        if ratio <= 0:
-                                            continue
-                                        formatted_opt.append((ratio, roma.strip()))
-                                    except (ValueError, IndexError):
-                                        continue
-                                else:
-                                    continue
-                            if formatted_opt:
-                                formatted_options.append(formatted_opt)
-                        if formatted_options:
-                            mapping[pinyin.strip()] = formatted_options
-                    except Exception:
-                        continue
+            mapping = kua_mapping.load_mapping(mapping_path)
             return mapping if mapping else None
         except Exception as e:
             messagebox.showerror("映射表错误", "加载失败：{0}".format(str(e)))
             return None
 
 class UstProcessor:
-    def __init__(self, ust_path):
+    def __init__(self, ust_path, parse=True):
         self.ust_path = ust_path
         self.sections = []
-        self._parse_ust()
+        if parse:
+            self._parse_ust()
 
     def _parse_ust(self):
-        current_section = None
         try:
-            with open(self.ust_path, 'r', encoding='shift_jis', errors='ignore') as f:
-                for line in f:
-                    line = line.strip()
-                    if line.startswith('[#'):
-                        current_section = {
-                            'header': line,
-                            'type': self._get_section_type(line),
-                            'data': {},
-                            'original_index': len(self.sections)
-                        }
-                        self.sections.append(current_section)
-                    elif current_section and '=' in line:
-                        try:
-                            key, value = line.split('=', 1)
-                            current_section['data'][key.strip()] = value.strip()
-                        except ValueError:
-                            continue
+            self.load()
         except Exception as e:
             messagebox.showerror("解析错误", "UST文件解析失败：{0}".format(str(e)))
 
-    def _get_section_type(self, header):
-        match = re.match(r'\[#(\d+|PREV|NEXT)\]', header)
-        if match:
-            return 'number' if match.group(1).isdigit() else match.group(1)
-        return 'other'
-
-    def save(self, sections):
-        try:
-            with open(self.ust_path, 'w', encoding='shift_jis', newline='\r\n', errors='ignore') as f:
-                for section in sections:
-                    f.write(section['header'] + '\r\n')
-                    for k, v in section['data'].items():
-                        f.write('{0}={1}\r\n'.format(k, v))
-            return True
-        except Exception as e:
-            messagebox.showerror("保存错误", "文件保存失败：{0}".format(str(e)))
-            return False
+    def load(self):
+        """读取并解析文件，出错时抛出异常（不弹窗，可在工作线程中调用）"""
+        self.sections = ust_core.parse_ust(self.ust_path)
 
 class MappingInterface:
-    def __init__(self, master, sections, mapping, ust_path):
+    def __init__(self, master, processor, mapping, oto=None):
         self.master = master
-        self.original_sections = sections
+        self.processor = processor
+        self.original_sections = processor.sections
         self.mapping = mapping
-        self.ust_path = ust_path
+        self.matcher = kua_mapping.LyricMatcher(mapping)
+        self.oto = oto  # 音源的别名索引（ust_oto.OtoIndex），找不到音源时为 None
+        self.ust_path = processor.ust_path
+        self.memory = kua_mapping.OptionMemory(
+            MEMORY_PATH, kua_mapping.project_key(self.original_sections, self.ust_path))
         self.modified_sections = []
         self.selections = {}
+        self.lyric_rows = {}     # 歌词 -> 可替换的行号列表，用于"同拼音全部应用"
+        self.selected_rows = set()
+        self._anchor_row = None  # Shift+单击选择范围的起点
         self.current_combobox = None
 
         master.title("映射替换工具")
@@ -122,62 +88,153 @@ class MappingInterface:
         ctrl_frame = tk.Frame(main_frame)
         self.overlap_var = tk.BooleanVar(value=True)
         self.pre_utterance_var = tk.BooleanVar(value=False)
-        ttk.Checkbutton(ctrl_frame, text="衔接处80ms的overlap", variable=self.overlap_var).pack(side='left', padx=5)
+        ttk.Checkbutton(ctrl_frame, text="衔接处的overlap（默认80ms）", variable=self.overlap_var).pack(side='left', padx=5)
         ttk.Checkbutton(ctrl_frame, text="设置PreUtterance为0", variable=self.pre_utterance_var).pack(side='left', padx=5)
-        ttk.Button(ctrl_frame, text="应用替换", command=self._apply_changes).pack(side='right')
+        self.alias_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(ctrl_frame, text="连续音（按aaaaa.txt连接）", variable=self.alias_var).pack(side='left', padx=5)
+        # 找到音源时默认勾选：按 oto.ini 挑方案、标出缺少的音，先行发声/重叠用 oto.ini 的值
+        self.oto_var = tk.BooleanVar(value=self.oto is not None)
+        ttk.Checkbutton(ctrl_frame, text="使用音源oto.ini", variable=self.oto_var, command=self._on_oto_toggle,
+                        state='normal' if self.oto is not None else 'disabled').pack(side='left', padx=5)
+        self.apply_button = ttk.Button(ctrl_frame, text="应用替换", command=self._apply_changes)
+        self.apply_button.pack(side='right')
         ctrl_frame.pack(fill='x', pady=5)
 
-        self.tree = ttk.Treeview(
-            main_frame,
-            columns=('type', 'lyric', 'options'),
-            show='headings',
-            selectmode='none'
-        )
+        bulk_frame = tk.Frame(main_frame)
+        self.apply_same_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(bulk_frame, text="选择方案时同拼音全部应用", variable=self.apply_same_var).pack(side='left', padx=5)
+        ttk.Label(bulk_frame, text="单击拼音选中行（Shift+单击选择范围），选中行一起修改").pack(side='left', padx=5)
+        ttk.Button(bulk_frame, text="清除选择", command=self._clear_selection).pack(side='right')
+        bulk_frame.pack(fill='x', pady=5)
+
+        self.rows = []  # 每节一行 (values, tags)，由 _populate_tree 分批填充
+        self.view = ust_gui.VirtualTree(main_frame, ('type', 'lyric', 'options'), self._view_row)
+        self.view.on_scroll = self._close_combobox
+        self.tree = self.view.tree
         self.tree.heading('type', text='类型')
         self.tree.heading('lyric', text='原拼音')
         self.tree.heading('options', text='替换方案')
         self.tree.column('type', width=100, anchor='center')
         self.tree.column('lyric', width=150, anchor='center')
         self.tree.column('options', width=350, anchor='w')
-
-        scrollbar = ttk.Scrollbar(main_frame, orient="vertical", command=self.tree.yview)
-        self.tree.configure(yscrollcommand=scrollbar.set)
-
-        self.tree.pack(side='left', fill='both', expand=True)
-        scrollbar.pack(side='right', fill='y')
+        self.tree.tag_configure('editable', background='#f0f0ff')
+        self.tree.tag_configure('uneditable', background='#f0f0f0')
+        self.tree.tag_configure('selected', background='#ffe0a0')
+        self.view.pack(fill='both', expand=True)
 
         self.tree.bind("<Double-1>", self._on_double_click)
+        self.tree.bind("<Button-1>", self._on_click)
+        self.tree.bind("<Shift-Button-1>", self._on_shift_click)
+        self._populate_job = None
+        self._populate_phase = ust_profile.phase('populate')  # 到最后一批填完为止
         self._populate_tree()
 
-    def _populate_tree(self):
-        for idx, section in enumerate(self.original_sections):
-            if section['type'] != 'number':
-                self._add_uneditable_row(section)
-                continue
-            lyric = section['data'].get('Lyric', '')
-            if lyric in self.mapping and len(self.mapping[lyric]) > 0:
-                options = self.mapping[lyric]
-                default_option = ', '.join(roma for _, roma in options[0])
-                self.selections[idx] = options[0]
-                self.tree.insert('', 'end', values=('可替换', lyric, default_option), tags=('editable',))
-            else:
-                self.tree.insert('', 'end', values=('无匹配', lyric, '--'), tags=('uneditable',))
-
-        self.tree.tag_configure('editable', background='#f0f0ff')
-        self.tree.tag_configure('uneditable', background='#f0f0f0')
-
-    def _add_uneditable_row(self, section):
+    def _populate_tree(self, batch_size=POPULATE_BATCH):
+        """先填一批（够显示第一屏），其余用 after() 分批填，窗口立刻出现"""
+        end = min(len(self.rows) + batch_size, len(self.original_sections))
+        for idx in range(len(self.rows), end):
+            self.rows.append(self._make_row(idx, self.original_sections[idx]))
+        self.view.set_count(len(self.rows))
+        if len(self.rows) < len(self.original_sections):
+            self._populate_job = self.master.after(1, self._populate_tree)
+        else:
+            self._populate_job = None
+            self._populate_phase.stop()
+
+    def _finish_populate(self):
+        if self._populate_job is not None:
+            self.master.after_cancel(self._populate_job)
+            self._populate_tree(len(self.original_sections))
+
+    def _make_row(self, idx, section):
+        if section.type != 'number':
+            return self._uneditable_row(section)
+        lyric = section.get('Lyric', '')
+        options = self.matcher.options(lyric)
+        if options:
+            oto = self._active_oto()
+            default = oto.first_available(options) if oto is not None else None
+            option = self.memory.choose(lyric, section.name, options, default)
+            self.selections[idx] = option
+            self.lyric_rows.setdefault(lyric, []).append(idx)
+            return (self._row_type(option), lyric, kua_mapping.option_label(option)), ('editable',)
+        return ('无匹配', lyric, '--'), ('uneditable',)
+
+    def _active_oto(self):
+        """勾选了"使用音源oto.ini"时为音源索引，否则为 None"""
+        return self.oto if self.oto_var.get() else None
+
+    def _row_type(self, option):
+        oto = self._active_oto()
+        if oto is not None and oto.missing(option):
+            return '缺少音源'
+        return '可替换'
+
+    def _on_oto_toggle(self):
+        # 已选的方案不变，只更新"缺少音源"的标记
+        for idx, option in self.selections.items():
+            values, tags = self.rows[idx]
+            self.rows[idx] = (self._row_type(option),) + tuple(values[1:]), tags
+        self.view.refresh()
+
+    def _uneditable_row(self, section):
         display_type = {
             'PREV': '前导音符',
             'NEXT': '后续音符',
+            'SETTING': '设置',
             'other': '其他'
-        }.get(section['type'], '特殊')
-        lyric = section['data'].get('Lyric', section['type'])
-        self.tree.insert('', 'end', values=(display_type, lyric, '（不可修改）'), tags=('uneditable',))
+        }.get(section.type, '特殊')
+        lyric = section.get('Lyric', section.type)
+        return (display_type, lyric, '（不可修改）'), ('uneditable',)
 
-    def _on_double_click(self, event):
+    def _view_row(self, idx):
+        values, tags = self.rows[idx]
+        return values, ('selected',) if idx in self.selected_rows else tags
+
+    def _close_combobox(self):
         if self.current_combobox:
             self.current_combobox.destroy()
+            self.current_combobox = None
+
+    def _clicked_row(self, event):
+        """单击位置对应的可替换行号，点在拼音/类型列以外或不可替换的行时返回 None"""
+        if self.tree.identify_column(event.x) == '#3':
+            return None
+        idx = self.view.index_of(self.tree.identify_row(event.y))
+        if idx is None or 'editable' not in self.rows[idx][1]:
+            return None
+        return idx
+
+    def _on_click(self, event):
+        idx = self._clicked_row(event)
+        if idx is None:
+            return
+        if idx in self.selected_rows:
+            self.selected_rows.discard(idx)
+        else:
+            self.selected_rows.add(idx)
+        self._anchor_row = idx
+        self.view.refresh_row(idx)
+
+    def _on_shift_click(self, event):
+        idx = self._clicked_row(event)
+        if idx is None:
+            return
+        start = idx if self._anchor_row is None else min(idx, self._anchor_row)
+        end = idx if self._anchor_row is None else max(idx, self._anchor_row)
+        for row in range(start, end + 1):
+            if 'editable' in self.rows[row][1]:
+                self.selected_rows.add(row)
+        self._anchor_row = idx
+        self.view.refresh()
+
+    def _clear_selection(self):
+        self.selected_rows.clear()
+        self._anchor_row = None
+        self.view.refresh()
+
+    def _on_double_click(self, event):
+        self._close_combobox()
 
         row_id = self.tree.identify_row(event.y)
         col_id = self.tree.identify_column(event.x)
@@ -185,13 +242,11 @@ class MappingInterface:
         if not row_id or col_id != '#3':
             return
 
-        item = self.tree.item(row_id)
-        if 'editable' not in self.tree.item(row_id, 'tags'):
+        idx = self.view.index_of(row_id)
+        if idx is None or 'editable' not in self.rows[idx][1]:
             return
 
-        idx = self.tree.index(row_id)
-        lyric = item['values'][1]
-        options = self.mapping.get(lyric, [])
+        options = self.matcher.options(self.rows[idx][0][1]) or []
 
         bbox = self.tree.bbox(row_id, col_id)
         if not bbox:
@@ -199,11 +254,11 @@ class MappingInterface:
 
         self.current_combobox = ttk.Combobox(
             self.tree,
-            values=[', '.join(roma for _, roma in opt) for opt in options],
+            values=[kua_mapping.option_label(opt) for opt in options],
             state='readonly',
             width=45
         )
-        self.current_combobox.set(item['values'][2])
+        self.current_combobox.set(self.rows[idx][0][2])
         self.current_combobox.place(
             x=bbox[0],
             y=bbox[1],
@@ -213,87 +268,182 @@ class MappingInterface:
 
         self.current_combobox.bind(
             "<<ComboboxSelected>>",
-            lambda e, r=row_id, i=idx: self._update_selection(r, i)
+            lambda e, i=idx: self._update_selection(i)
         )
 
-    def _update_selection(self, row_id, original_idx):
-        selected = self.current_combobox.get()
-        options = self.mapping.get(self.tree.item(row_id)['values'][1], [])
-        for opt in options:
-            if ', '.join(roma for _, roma in opt) == selected:
-                self.selections[original_idx] = opt
-                break
-        self.tree.set(row_id, 'options', selected)
-        self.current_combobox.destroy()
-        self.current_combobox = None
+    def _update_selection(self, original_idx):
+        """按下拉框里的序号设置方案；选中行、（勾选时）同拼音的行一起改为同一序号的方案"""
+        option_index = self.current_combobox.current()
+        self._close_combobox()
+        if option_index < 0:
+            return
+        targets = [original_idx]
+        if original_idx in self.selected_rows:
+            targets.extend(sorted(self.selected_rows))
+        if self.apply_same_var.get():
+            self._finish_populate()
+            targets.extend(self.lyric_rows.get(self.rows[original_idx][0][1], ()))
+        for idx in set(targets):
+            self._set_option(idx, option_index)
+
+    def _set_option(self, idx, option_index):
+        values, tags = self.rows[idx]
+        options = self.matcher.options(values[1]) or []
+        if option_index >= len(options):
+            return  # 其他拼音的方案没有这么多，保持不变
+        option = options[option_index]
+        self.selections[idx] = option
+        self.rows[idx] = (self._row_type(option), values[1], kua_mapping.option_label(option)), tags
+        self.view.refresh_row(idx)
 
     def _apply_changes(self):
-        new_sections = []
-        for idx, section in enumerate(self.original_sections):
-            if section['type'] != 'number':
-                # 非数字节直接保留
-                new_sections.append(section)
-                continue
-            if idx not in self.selections:
-                # 无替换方案的数字节保留
-                new_sections.append(section)
-                continue
-            # 生成新音符
-            original_note = section
-            romaji_list = self.selections[idx]
-            new_notes = self._generate_new_notes(original_note, romaji_list)
-            new_sections.extend(new_notes)
-            # 添加删除指令，包含原始音符的完整 data
-            new_sections.append({
-                'header': '[#DELETE]',
-                'type': 'number',
-                'data': section['data'].copy()  # 复制原始音符的 data
-            })
-
-        # 保存新节
-        if UstProcessor(self.ust_path).save(new_sections):
-            messagebox.showinfo("完成", "替换操作已完成")
-            self.master.destroy()
-
-    def _generate_new_notes(self, original_note, romaji_list):
-        new_notes = []
-        total_length = int(original_note['data'].get('Length', 480))
-        total_ratio = sum(ratio for ratio, _ in romaji_list) or 10
-        for i, (ratio, roma_sound) in enumerate(romaji_list):
-            note_length = int(total_length * ratio / total_ratio)
-            if note_length <= 0:
-                continue
-            new_note = {
-                'header': '[#INSERT]',
-                'type': 'number',
-                'data': {
-                    'Lyric': roma_sound,
-                    'Length': str(note_length),
-                    'NoteNum': original_note['data'].get('NoteNum', '60'),
-                    'PreUtterance': '0' if self.pre_utterance_var.get() else '',
-                    'VoiceOverlap': '80' if self.overlap_var.get() and i > 0 else '0'
-                }
-            }
-            # 如果原始音符有 Tempo，且当前是第一个音符，添加 Tempo
-            if i == 0 and 'Tempo' in original_note['data']:
-                new_note['data']['Tempo'] = original_note['data']['Tempo']
-            new_notes.append(new_note)
-        return new_notes
+        self._finish_populate()
+        ust_profile.note(replaced=len(self.selections))
+        # 勾选项在主线程里读好，工作线程不碰界面
+        options = {
+            'overlap': self.overlap_var.get(),
+            'pre_utterance': self.pre_utterance_var.get(),
+            'oto': self._active_oto(),
+        }
+        aliases = self.alias_var.get()
+        selections = dict(self.selections)
+        # 应用进行中不能再点一次，否则两次替换会同时保存
+        self.apply_button.config(state='disabled')
+        ust_gui.BackgroundTask(self.master, "应用替换",
+                               lambda task: self._replace(task, selections, options, aliases),
+                               lambda saved: self._on_replaced(selections), on_abort=self._enable_apply)
+
+    def _enable_apply(self):
+        self.apply_button.config(state='normal')
+
+    def _replace(self, task, selections, options, aliases):
+        """工作线程：拆音、按别名表连接并保存（不操作界面）"""
+        with ust_profile.phase('apply'):
+            new_sections = kua_mapping.replace_notes(self.original_sections, selections, task=task, **options)
+
+        if aliases:
+            task.report(0.6, "按别名表连接...")
+            try:
+                with ust_profile.phase('aliases'):
+                    alias_table = kua_mapping.AliasTable.load(ALIAS_PATH)
+                    new_sections = kua_mapping.apply_aliases(new_sections, alias_table)
+            except Exception as e:
+                raise ValueError("别名表加载失败：{0}".format(str(e)))
+
+        # 开始写文件后不能再取消
+        task.commit("保存...")
+        with ust_profile.phase('save'):
+            try:
+                ust_core.write_ust(self.ust_path, new_sections, changed_only=True)
+            except Exception as e:
+                raise ValueError("文件保存失败：{0}".format(str(e)))
+
+    def _on_replaced(self, selections):
+        # 记住这次的选择，下次打开同一工程时沿用
+        self.memory.remember(
+            (self.rows[idx][0][1], self.original_sections[idx].name, option)
+            for idx, option in selections.items())
+        messagebox.showinfo("完成", "替换操作已完成")
+        self.master.destroy()
+
+def batch_main(argv):
+    """无界面批量模式：python kua_3_fix.py --batch -o 输出文件夹 文件或通配符..."""
+    import argparse
+    import glob
+    import time
+
+    parser = argparse.ArgumentParser(prog='kua_3_fix.py --batch', description='批量拆音（每个拼音都使用第一个方案）')
+    parser.add_argument('inputs', nargs='+', help='UST 文件或通配符，如 songs/*.ust')
+    parser.add_argument('-o', '--output', required=True, help='输出文件夹')
+    parser.add_argument('--mapping', default=os.path.join(PLUGIN_DIR, "pinyin.txt"), help='映射表路径')
+    parser.add_argument('--no-overlap', action='store_true', help='不设置衔接处80ms的overlap')
+    parser.add_argument('--pre-utterance-zero', action='store_true', help='设置PreUtterance为0')
+    parser.add_argument('--aliases', nargs='?', const=ALIAS_PATH, help='连续音模式，按别名表（默认aaaaa.txt）连接')
+    parser.add_argument('--voice-dir', help='音源文件夹：按其中的oto.ini选方案并使用真实的先行发声/重叠')
+    args = parser.parse_args(argv)
+
+    paths = []
+    for pattern in args.inputs:
+        matched = sorted(glob.glob(pattern))
+        paths.extend(matched if matched else [pattern])
+    mapping = kua_mapping.load_mapping(args.mapping)
+    alias_table = kua_mapping.AliasTable.load(args.aliases) if args.aliases else None
+    oto = ust_oto.OtoIndex.load(args.voice_dir, PLUGIN_DIR) if args.voice_dir else None
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    total_notes = 0
+    failed = 0
+    start = time.perf_counter()
+    for path in paths:
+        out_path = os.path.join(args.output, os.path.basename(path))
+        try:
+            sections = ust_core.parse_ust(path)
+            new_sections, note_count = kua_mapping.split_project(
+                sections, mapping,
+                overlap=not args.no_overlap,
+                pre_utterance=args.pre_utterance_zero,
+                alias_table=alias_table,
+                oto=oto
+            )
+            ust_core.write_ust(out_path, new_sections)
+        except Exception as e:
+            failed += 1
+            print("{0}: 失败：{1}".format(path, e))
+            continue
+        total_notes += note_count
+        print("{0}: {1} 个音符 -> {2}".format(path, note_count, out_path))
+    elapsed = time.perf_counter() - start
+    print("共 {0} 个文件（失败 {1}），{2} 个音符，用时 {3:.2f} 秒，{4:.0f} 音符/秒".format(
+        len(paths), failed, total_notes, elapsed, total_notes / elapsed if elapsed else 0))
+    return 1 if failed else 0
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--batch':
+        sys.exit(batch_main(sys.argv[2:]))
+    _import_tkinter()
     if len(sys.argv) < 2:
         messagebox.showerror("错误", "请通过UTAU插件菜单运行")
         return
-    mapper = MappingManager()
-    if not mapper.mapping:
-        return
     ust_path = sys.argv[-1]
-    processor = UstProcessor(ust_path)
-    if not processor.sections:
-        return
-    root = tk.Tk()
-    MappingInterface(root, processor.sections, mapper.mapping, ust_path)
-    root.mainloop()
+    with ust_profile.session('kua_3_fix', ust_path):
+        with ust_profile.phase('mapping'):
+            mapper = MappingManager()
+        if not mapper.mapping:
+            return
+        root = tk.Tk()
+        root.withdraw()
+
+        def work(task):
+            task.report(0.0, "读取UST文件...")
+            processor = UstProcessor(ust_path, parse=False)
+            with ust_profile.phase('parse'):
+                processor.load()
+            ust_profile.note(sections=len(processor.sections))
+            # 音源的 oto.ini 索引（可选）：用来挑音源里有的方案、取真实的先行发声/重叠
+            oto = None
+            voice_dir = ust_oto.resolve_voice_dir(processor.sections, ust_path, PLUGIN_DIR)
+            if voice_dir:
+                task.report(0.5, "读取音源oto.ini...")
+                try:
+                    with ust_profile.phase('oto'):
+                        oto = ust_oto.OtoIndex.load(voice_dir, PLUGIN_DIR)
+                except (OSError, ValueError):
+                    oto = None  # 读不了音源时照常拆音
+            task.report(1.0)
+            return processor, oto
+
+        def done(result):
+            processor, oto = result
+            if not processor.sections:
+                root.destroy()
+                return
+            root.deiconify()
+            with ust_profile.phase('interface'):
+                MappingInterface(root, processor, mapper.mapping, oto)
+
+        ust_gui.BackgroundTask(root, "读取中", work, done, on_abort=root.destroy)
+        root.mainloop()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,556 @@
+# -*- coding: utf-8 -*-
+'''
+拼音映射表（pinyin.txt / pinyin_nao.txt）的读取与缓存，供 kua_3_fix.py、kua_3.py 共用。
+第一次读取后会在映射表旁边生成 .cache 文件，之后的启动直接读缓存。
+'''
+import os
+import json
+import time
+import hashlib
+import marshal
+from collections import Counter
+
+import ust_core
+
+CACHE_VERSION = 1
+CACHE_SUFFIX = '.cache'
+
+
+def parse_mapping_lines(lines):
+    """把映射表的文本行解析成 {拼音: [[(比例, 罗马音), ...], ...]}"""
+    mapping = {}
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#') or ';' not in line:
+            continue
+        pinyin, romaji = line.split(';', 1)
+        formatted_options = []
+        for opt in romaji.split('_'):
+            formatted_opt = []
+            for part in opt.split(','):
+                ratio, dot, roma = part.partition('.')
+                if not dot:
+                    continue
+                try:
+                    ratio = int(ratio)
+                except ValueError:
+                    continue
+                if ratio <= 0:
+                    continue
+                formatted_opt.append((ratio, roma.strip()))
+            if formatted_opt:
+                formatted_options.append(formatted_opt)
+        if formatted_options:
+            mapping[pinyin.strip()] = formatted_options
+    return mapping
+
+
+def _source_key(st):
+    return (CACHE_VERSION, marshal.version, st.st_mtime_ns, st.st_size)
+
+
+def _read_cache(cache_path):
+    try:
+        with open(cache_path, 'rb') as f:
+            return marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+def _write_cache(cache_path, key, digest, mapping):
+    ust_core.save_cache(cache_path, marshal.dumps((key, digest, mapping)))
+
+
+def load_mapping(mapping_path, use_cache=True):
+    """
+    读取映射表。缓存以源文件的修改时间+大小为键，键不一致时再比较内容哈希，
+    哈希也不一致才重新解析
+    """
+    st = os.stat(mapping_path)
+    key = _source_key(st)
+    cache_path = mapping_path + CACHE_SUFFIX
+    cached = _read_cache(cache_path) if use_cache else None
+    if cached is not None and cached[0] == key:
+        return cached[2]
+
+    with open(mapping_path, 'rb') as f:
+        raw = f.read()
+    digest = hashlib.sha1(raw).hexdigest()
+    if cached is not None and cached[1] == digest and cached[0][:2] == key[:2]:
+        mapping = cached[2]
+    else:
+        mapping = parse_mapping_lines(raw.decode('utf-8').splitlines())
+    if use_cache:
+        _write_cache(cache_path, key, digest, mapping)
+    return mapping
+
+
+class LyricMatcher(object):
+    """
+    把映射表的键编译成前缀树，按最长前缀匹配歌词。除了整词匹配外还支持：
+    前缀（如 '- ai'，开头的非字母数字字符）、后缀（如 'ai_2'、'ai↑'，匹配完后剩下的以非字母数字开头的部分）、
+    多音节（如 'nihao' 拆成 ni + hao）。结果按歌词缓存，同一歌词只匹配一次
+    """
+    _END = ''  # 前缀树结点中保存完整键的位置（单个字符不会是空串）
+
+    def __init__(self, mapping):
+        self.mapping = mapping
+        self.root = {}
+        for key in mapping:
+            if not key:
+                continue
+            node = self.root
+            for ch in key:
+                node = node.setdefault(ch, {})
+            node[self._END] = key
+        self._cache = {}
+
+    def split(self, lyric):
+        """返回 (前缀, [音节, ...], 后缀)，匹配不上时返回 None。歌词两端的空白不算前缀/后缀（音源里没有带空格的音）"""
+        lyric = lyric.strip()
+        start = 0
+        while start < len(lyric) and not lyric[start].isalnum():
+            start += 1
+        syllables = self._segment(lyric, start)
+        if syllables is None:
+            return None
+        end = start + sum(len(syllable) for syllable in syllables)
+        return lyric[:start], syllables, lyric[end:]
+
+    def _ends(self, lyric, pos):
+        """从 pos 开始能匹配的各个键的结尾位置，从短到长"""
+        ends = []
+        node = self.root
+        for i in range(pos, len(lyric)):
+            node = node.get(lyric[i])
+            if node is None:
+                break
+            if self._END in node:
+                ends.append(i + 1)
+        return ends
+
+    def _segment(self, lyric, start):
+        # 深度优先，每个位置先试最长的键；键的结尾处是歌词末尾或非字母数字（后缀）时成功，否则从结尾处继续拆。
+        # 拆不下去的位置记在 failed 里不再重试，每个位置最多走一次前缀树，总共 O(歌词长度 × 最长键长)
+        n = len(lyric)
+        failed = set()
+        stack = [[start, self._ends(lyric, start), start]]  # [位置, 还没试的结尾, 当前选用的结尾]
+        while stack:
+            frame = stack[-1]
+            if not frame[1]:
+                failed.add(frame[0])
+                stack.pop()
+                continue
+            end = frame[2] = frame[1].pop()
+            if end == n or not lyric[end].isalnum():
+                return [lyric[pos:chosen] for pos, _, chosen in stack]
+            if end not in failed:
+                stack.append([end, self._ends(lyric, end), end])
+        return None
+
+    def options(self, lyric):
+        """返回歌词的拆分方案列表（格式同映射表的值），没有匹配时返回 None"""
+        try:
+            return self._cache[lyric]
+        except KeyError:
+            pass
+        options = self.mapping.get(lyric) or None
+        if options is None:
+            parts = self.split(lyric)
+            if parts is not None:
+                options = self._combine(*parts)
+        self._cache[lyric] = options
+        return options
+
+    def _combine(self, prefix, syllables, suffix):
+        if len(syllables) == 1 and not prefix and not suffix:
+            return self.mapping[syllables[0]]
+        per_syllable = [self.mapping[syllable] for syllable in syllables]
+        totals = [[sum(ratio for ratio, _ in option) for option in options] for options in per_syllable]
+        options = []
+        # 第 k 个方案：每个音节取自己的第 k 个方案（不够时取最后一个），各音节等长
+        for k in range(max(len(option_list) for option_list in per_syllable)):
+            chosen = [min(k, len(option_list) - 1) for option_list in per_syllable]
+            chosen_totals = [totals[i][j] for i, j in enumerate(chosen)]
+            combined = []
+            for i, j in enumerate(chosen):
+                scale = 1
+                for other, total in enumerate(chosen_totals):
+                    if other != i:
+                        scale *= total
+                for ratio, roma in per_syllable[i][j]:
+                    combined.append((ratio * scale, roma + suffix))
+            combined[0] = (combined[0][0], prefix + combined[0][1])
+            if combined not in options:
+                options.append(combined)
+        return options
+
+
+_split_cache = {}
+_SPLIT_CACHE_LIMIT = 65536
+
+
+def split_lengths(ratios, total_length):
+    """
+    按比例把 total_length 分成整数长度，余数按最大余数法分配（余数相同时靠前的优先），
+    各段之和正好等于 total_length。ratios 为元组，结果按 (ratios, total_length) 缓存
+    """
+    key = (ratios, total_length)
+    try:
+        return _split_cache[key]
+    except KeyError:
+        pass
+    total_ratio = sum(ratios)
+    if total_ratio <= 0 or total_length <= 0:
+        lengths = (0,) * len(ratios)
+    else:
+        lengths = [total_length * ratio // total_ratio for ratio in ratios]
+        remainders = [total_length * ratio % total_ratio for ratio in ratios]
+        left = total_length - sum(lengths)
+        for i in sorted(range(len(ratios)), key=lambda i: -remainders[i])[:left]:
+            lengths[i] += 1
+        lengths = tuple(lengths)
+    if len(_split_cache) >= _SPLIT_CACHE_LIMIT:
+        _split_cache.clear()
+    _split_cache[key] = lengths
+    return lengths
+
+
+def option_label(option):
+    """方案的显示文字，如 'a, i'，也用作保存选择时的键"""
+    return ', '.join(roma for _, roma in option)
+
+
+def project_key(sections, ust_path):
+    """工程的标识：优先用 [#SETTING] 里的工程路径/输出文件/工程名，都没有时用 UST 路径"""
+    for section in sections:
+        if section.type == 'SETTING':
+            for key in ('Project', 'OutFile', 'ProjectName'):
+                value = section.get(key)
+                if value:
+                    return value
+    return os.path.abspath(ust_path)
+
+
+class OptionMemory(object):
+    """
+    记住每个工程里用户选过的方案，保存在 JSON 文件中：
+    {工程: {'time': 保存时间, 'choices': {'歌词@位置': 方案, '歌词': 该歌词最常用的方案}}}。
+    先按歌词+位置（节名）查，没有时按歌词查，都没有时用第一个方案
+    """
+    MAX_PROJECTS = 100
+
+    def __init__(self, path, project):
+        self.path = path
+        self.project = project
+        self._store = self._read()
+        self.choices = self._store.get(project, {}).get('choices', {})
+
+    def _read(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                store = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return store if isinstance(store, dict) else {}
+
+    def choose(self, lyric, position, options, default=None):
+        """返回记住的方案，找不到（或映射表里已经没有这个方案）时返回 default，没有 default 时返回第一个方案"""
+        label = self.choices.get('{0}@{1}'.format(lyric, position)) or self.choices.get(lyric)
+        if label:
+            for option in options:
+                if option_label(option) == label:
+                    return option
+        return default if default is not None else options[0]
+
+    def remember(self, entries):
+        """
+        entries 为 (歌词, 位置, 方案)，合并到本工程原来记住的内容并写回文件：
+        分几次选区拆音时，前几次记住的位置不会丢。各歌词最常用的方案按合并后的所有位置重新统计
+        """
+        positions = dict((key, label) for key, label in self.choices.items() if '@' in key)
+        for lyric, position, option in entries:
+            positions['{0}@{1}'.format(lyric, position)] = option_label(option)
+        per_lyric = {}
+        for key, label in positions.items():
+            per_lyric.setdefault(key.rpartition('@')[0], Counter())[label] += 1
+        choices = dict(positions)
+        for lyric, counter in per_lyric.items():
+            choices[lyric] = counter.most_common(1)[0][0]
+        self.choices = choices
+        self._store[self.project] = {'time': time.time(), 'choices': choices}
+        if len(self._store) > self.MAX_PROJECTS:
+            # 只保留最近保存的工程
+            recent = sorted(self._store, key=lambda key: self._store[key].get('time', 0), reverse=True)
+            for key in recent[self.MAX_PROJECTS:]:
+                del self._store[key]
+        ust_core.save_cache(self.path, json.dumps(self._store, ensure_ascii=False))
+
+
+def generate_new_notes(original_note, romaji_list, overlap=True, pre_utterance=False, oto=None, tempo=None):
+    """
+    按方案把一个音符拆成若干 [#INSERT] 音符，各音符长度之和等于原音符长度。
+    给出音源索引 oto（ust_oto.OtoIndex）时，先行发声/重叠使用 oto.ini 里该音的值，而不是固定的 空/80。
+    给出该音符处生效的曲速 tempo 时，重叠不超过前一个拆出音符的实际时长（毫秒）
+    """
+    new_notes = []
+    total_length = int(original_note.get('Length', 480))
+    lengths = split_lengths(tuple(ratio for ratio, _ in romaji_list), total_length)
+    note_num = original_note.get('NoteNum', '60')
+    ms_per_tick = 60000.0 / (tempo * ust_core.TICKS_PER_BEAT) if tempo else None
+    previous_length = 0
+    note_tempo = original_note.get('Tempo')
+    for i, (_, roma_sound) in enumerate(romaji_list):
+        note_length = lengths[i]
+        if note_length <= 0:
+            continue
+        voice = oto.get(roma_sound) if oto is not None else None  # (先行发声, 重叠)
+        if overlap and i > 0:
+            voice_overlap = voice[1] if voice and voice[1] else '80'
+            if ms_per_tick and previous_length:
+                limit = int(previous_length * ms_per_tick)
+                try:
+                    if float(voice_overlap) > limit:
+                        voice_overlap = str(limit)
+                except ValueError:
+                    pass
+        else:
+            voice_overlap = '0'
+        previous_length = note_length
+        data = {
+            'Lyric': roma_sound,
+            'Length': str(note_length),
+            'NoteNum': note_num,
+            'PreUtterance': '0' if pre_utterance else (voice[0] if voice else ''),
+            'VoiceOverlap': voice_overlap
+        }
+        # 如果原始音符有 Tempo，且当前是第一个音符，添加 Tempo
+        if i == 0 and note_tempo is not None:
+            data['Tempo'] = note_tempo
+        new_notes.append(ust_core.UstSection('[#INSERT]', 'number', data=data))
+    return new_notes
+
+
+def replace_notes(sections, selections, overlap=True, pre_utterance=False, oto=None, task=None):
+    """
+    插件写回用的节列表：selections（节序号 -> 方案）中的音符换成拆出的 [#INSERT] 音符和原音符的 [#DELETE]，
+    其余节原样保留。拆音时使用各音符处生效的曲速；task 用于在工作线程中汇报进度（0~0.6）
+    """
+    new_sections = ust_core.SectionList(encoding=getattr(sections, 'encoding', None))
+    # 每个音符处生效的曲速（工程中途变速时各处不同）
+    timeline = ust_core.Timeline.from_sections(sections)
+    row = -1
+    for idx, section in enumerate(sections):
+        if task is not None and idx % 5000 == 0:
+            task.report(0.6 * idx / len(sections), "拆音...")
+        if section.type != 'number':
+            new_sections.append(section)
+            continue
+        row += 1
+        if idx not in selections:
+            new_sections.append(section)
+            continue
+        new_sections.extend(generate_new_notes(
+            section, selections[idx], overlap, pre_utterance, oto, timeline.note_tempo(row)))
+        # 删除指令带上原音符的完整 data
+        new_sections.append(ust_core.UstSection('[#DELETE]', 'number', data=section.data.copy()))
+    return new_sections
+
+
+ALIAS_TRANSITION_LENGTH = 60  # 连续音模式中切出的 "V C"/"V -" 过渡音长度（tick）
+REST_LYRICS = ust_core.REST_LYRICS
+
+
+class AliasTable(object):
+    """
+    连续音（VCV/CVVC）音源的别名表，如 aaaaa.txt（"- bOI"、"OI b"、"bOI"、"@ b-"、"OI -"）。
+    别名放进集合里一次建好；元音取自 "V -"
+    """
+
+    def __init__(self, aliases):
+        self.aliases = frozenset(alias.strip() for alias in aliases if alias.strip())
+        self.vowels = set()
+        for alias in self.aliases:
+            first, sep, second = alias.partition(' ')
+            if sep and first != '-' and second == '-':
+                self.vowels.add(first)
+        self._split_cache = {}
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            return cls(f.read().splitlines())
+
+    def split(self, lyric):
+        """把音拆成 (辅音, 元音)，元音取最长的元音后缀，没有元音时为 (lyric, '')"""
+        try:
+            return self._split_cache[lyric]
+        except KeyError:
+            pass
+        result = (lyric, '')
+        for i in range(len(lyric)):
+            if lyric[i:] in self.vowels:
+                result = (lyric[:i], lyric[i:])
+                break
+        self._split_cache[lyric] = result
+        return result
+
+    def connect(self, prev, lyric):
+        """
+        根据前一个音（None 表示句首）返回 (本音的别名, 要插在本音前的过渡音别名或 None)
+        """
+        if prev is None:
+            head = '- ' + lyric
+            return (head if head in self.aliases else lyric), None
+        vowel = self.split(prev)[1]
+        if not vowel:
+            return lyric, None
+        consonant, own_vowel = self.split(lyric)
+        if not consonant or not own_vowel:
+            # 纯元音/纯辅音（如拆出来的 n）直接接在前一个元音后面
+            alias = vowel + ' ' + lyric
+            return (alias if alias in self.aliases else lyric), None
+        transition = vowel + ' ' + consonant
+        return lyric, (transition if transition in self.aliases else None)
+
+    def tail(self, prev):
+        """句尾的 "V -"，没有时返回 None"""
+        vowel = self.split(prev)[1]
+        alias = vowel + ' -'
+        return alias if vowel and alias in self.aliases else None
+
+
+def _base_lyric(lyric):
+    # 已经是别名（如 "a ka"、"- ka"）时取最后一段作为前后文
+    return lyric.rsplit(' ', 1)[-1]
+
+
+def _carve(note, alias, length):
+    """从拆出来的音符末尾切出一个过渡音，音符太短（不到两倍）时不切"""
+    try:
+        note_length = int(note.data['Length'])
+    except (KeyError, ValueError):
+        return None
+    if note_length < length * 2:
+        return None
+    note.data['Length'] = str(note_length - length)
+    return ust_core.UstSection('[#INSERT]', 'number', data={
+        'Lyric': alias,
+        'Length': str(length),
+        'NoteNum': note.data.get('NoteNum', '60'),
+        'PreUtterance': note.data.get('PreUtterance', ''),
+        'VoiceOverlap': note.data.get('VoiceOverlap', '0'),
+    })
+
+
+def apply_aliases(sections, table, transition_length=ALIAS_TRANSITION_LENGTH):
+    """
+    连续音模式：一次线性遍历，把拆出来的 [#INSERT] 音符按前后文改成 table 里的别名。
+    句首加 "- "，元音后的纯元音/纯辅音改成 "V X"，元音后的 CV 前从上一个拆出的音符末尾切出 "V C"，
+    句尾切出 "V -"。原有音符和 PREV/NEXT 只作为前后文，不会被修改
+    """
+    result = ust_core.SectionList(encoding=getattr(sections, 'encoding', None))
+    prev = None         # 前一个音的基本歌词，None 表示句首
+    prev_insert = None  # 前一个音是拆出来的音符时为该节，过渡音从它末尾切出
+
+    def close_phrase():
+        if prev_insert is not None and prev is not None:
+            alias = table.tail(prev)
+            tail = _carve(prev_insert, alias, transition_length) if alias else None
+            if tail is not None:
+                result.append(tail)
+
+    for section in sections:
+        if section.header == '[#DELETE]':
+            result.append(section)
+            continue
+        lyric = section.get('Lyric', '') if section.type in ('number', 'PREV', 'NEXT') else None
+        if ust_core.is_rest(lyric):
+            close_phrase()
+            prev = prev_insert = None
+            result.append(section)
+            continue
+        if section.header != '[#INSERT]':
+            result.append(section)
+            prev = _base_lyric(lyric.strip())
+            prev_insert = None
+            continue
+        alias, transition = table.connect(prev, lyric)
+        if transition and prev_insert is not None:
+            note = _carve(prev_insert, transition, transition_length)
+            if note is not None:
+                result.append(note)
+        section.data['Lyric'] = alias
+        result.append(section)
+        prev = _base_lyric(lyric)
+        prev_insert = section
+    close_phrase()
+    return result
+
+
+class ProjectSplitter(object):
+    """
+    无界面模式的拆音：每个能匹配的音符都用第一个方案（有音源索引 oto 时用第一个音都齐全的方案）拆开，
+    音符重新编号。逐节调用，可直接作为 ust_core.stream_transform 的 transform
+    """
+
+    def __init__(self, mapping, overlap=True, pre_utterance=False, oto=None):
+        self.mapping = mapping
+        self.matcher = LyricMatcher(mapping)
+        self.overlap = overlap
+        self.pre_utterance = pre_utterance
+        self.oto = oto
+        self.number = 0
+        self.tempo = ust_core.DEFAULT_TEMPO  # 当前生效的曲速，逐节跟踪
+
+    def __call__(self, section):
+        self.tempo = ust_core.parse_tempo(section.get('Tempo')) or self.tempo
+        if section.type != 'number':
+            return [section]
+        options = self.matcher.options(section.get('Lyric', ''))
+        notes = None
+        if options:
+            option = self.oto.first_available(options) if self.oto is not None else options[0]
+            notes = generate_new_notes(section, option, self.overlap, self.pre_utterance, self.oto, self.tempo)
+        if not notes:
+            notes = [section]
+        for note in notes:
+            note.header = '[#{0:04d}]'.format(self.number)
+            self.number += 1
+        return notes
+
+
+def split_project(sections, mapping, overlap=True, pre_utterance=False, alias_table=None, oto=None):
+    """
+    拆开整个工程，返回 (新节列表, 原音符数)。给出 alias_table 时按连续音别名连接，
+    给出 oto 时按音源里实际有的音选方案
+    """
+    splitter = ProjectSplitter(mapping, overlap, pre_utterance, oto)
+    new_sections = ust_core.SectionList(encoding=getattr(sections, 'encoding', None))
+    note_count = 0
+    for section in sections:
+        if section.type == 'number':
+            note_count += 1
+        for new_section in splitter(section):
+            new_section.original_index = len(new_sections)
+            new_sections.append(new_section)
+    if alias_table is not None:
+        # 批量模式整首歌都会重写，所有音符都标成 [#INSERT] 参与连接，连接完再统一编号
+        for section in new_sections:
+            if section.type == 'number':
+                section.header = '[#INSERT]'
+        new_sections = apply_aliases(new_sections, alias_table)
+        number = 0
+        for index, section in enumerate(new_sections):
+            section.original_index = index
+            if section.type == 'number':
+                section.header = '[#{0:04d}]'.format(number)
+                number += 1
+    return new_sections, note_count
+
+
+def reset_pre_utterance(section):
+    """把数字节的 PreUtterance 设为 0（流式处理用）"""
+    if section.type == 'number':
+        section.data['PreUtterance'] = '0'
+    return section
@@ -1,179 +1,134 @@
 # -*- coding: utf-8 -*-
 import sys
 import os
-import re
-import tkinter as tk
-import tkinter.messagebox as messagebox
-import tkinter.filedialog as filedialog
-from tkinter import ttk
+
+import ust_core
+import ust_pitch
+
+ust_profile = ust_core.load_profile()
+
+tk = ttk = messagebox = filedialog = ust_gui = None  # 界面用的模块，由 _import_tkinter() 导入
+
+
+def _import_tkinter():
+    """打开窗口前才导入 tkinter 和 ust_gui：ust_batch 的工作进程只用 UstProcessor，不需要 tkinter"""
+    global tk, ttk, messagebox, filedialog, ust_gui
+    import tkinter as tk
+    import tkinter.messagebox as messagebox
+    import tkinter.filedialog as filedialog
+    from tkinter import ttk
+    import ust_gui
+
 
 class UstProcessor:
-    def __init__(self, file_path, encoding='shift_jis'):
+    def __init__(self, file_path, encoding=None, parse=True):
         self.file_path = file_path
         self.encoding = encoding
-        self.sections = []
+        self.notes = None
         self.total_ticks = 0
+        self.timeline = None
         self.is_mode2 = False
-        self._parse_file()
+        if parse:
+            self._parse_file()
 
     def _parse_file(self):
-        current_section = None
         try:
-            with open(self.file_path, 'r', encoding=self.encoding, errors='ignore') as f:
-                for line in f:
-                    line = line.strip()
-                    if line.startswith('[#'):
-                        current_section = {
-                            'header': line,
-                            'type': self._get_section_type(line),
-                            'data': {},
-                            'original_index': len(self.sections)
-                        }
-                        self.sections.append(current_section)
-                    elif current_section and '=' in line:
-                        try:
-                            key, value = line.split('=', 1)
-                            current_section['data'][key.strip()] = value.strip()
-                            if current_section['type'] == 'SETTING' and key.strip() == 'Mode2':
-                                self.is_mode2 = value.strip().lower() == 'true'
-                        except ValueError:
-                            continue
-        except UnicodeDecodeError:
-            if self.encoding == 'shift_jis' and 'tmp' not in self.file_path.lower():
-                self.encoding = 'utf-8'
-                self.sections = []
-                self._parse_file()
-            else:
-                messagebox.showerror("解析错误", "无法解析文件：{0}".format(self.file_path))
+            self.load()
         except Exception as e:
-            messagebox.showerror("解析错误", "文件解析失败：{0}".format(str(e)))
-
-        for section in self.sections:
-            if section['type'] == 'number':
-                length = section['data'].get('Length', '0')
-                try:
-                    self.total_ticks += int(length)
-                except ValueError:
-                    continue
-
-    def _get_section_type(self, header):
-        match = re.match(r'\[#(\d+|PREV|NEXT|SETTING)\]', header)
-        if match:
-            return 'number' if match.group(1).isdigit() else match.group(1)
-        return 'other'
+            ust_core.messagebox().showerror("解析错误", "文件解析失败：{0}".format(str(e)))
+
+    def load(self):
+        """读取并解析文件，出错时抛出异常（不弹窗，可在工作线程中调用）"""
+        sections = ust_core.parse_ust(self.file_path, encoding=self.encoding)
+        for section in sections:
+            if section.type == 'SETTING':
+                mode2 = section.get('Mode2')
+                if mode2 is not None:
+                    self.is_mode2 = mode2.lower() == 'true'
+        self.encoding = sections.encoding
+        self.notes = ust_core.NoteTable(sections)
+        # notes.starts 是各音符的起始 tick（前缀和），整个文件只算一次
+        self.total_ticks = self.notes.total_ticks()
+        self.timeline = None
+
+    def get_timeline(self):
+        """带曲速的时间轴，用于换算秒数（中途变速时也准确），第一次用到时才建立"""
+        if self.timeline is None and self.notes is not None:
+            self.timeline = self.notes.timeline()
+        return self.timeline
+
+    def length_text(self):
+        """总长度的说明，如 "3840 tick（8.00 秒）" """
+        timeline = self.get_timeline()
+        seconds = timeline.seconds(self.total_ticks) if timeline is not None else 0.0
+        return "{0} tick（{1:.2f} 秒）".format(self.total_ticks, seconds)
 
     def get_pitch_and_vibrato_data(self):
         """提取音高线和颤音数据"""
-        pitch_timeline = []
+        ticks = []
+        cents = []
         vibrato_data = []
-        current_tick = 0
-        for section in self.sections:
-            if section['type'] != 'number':
-                continue
-            length = int(section['data'].get('Length', '0'))
+        notes = self.notes
+        for row, length in enumerate(notes.lengths):
             if length <= 0:
                 continue
+            current_tick = notes.starts[row]
 
             # 音高字段
-            pbs = section['data'].get('PBS', '0').split(';')[0]
-            pbw = section['data'].get('PBW', '').split(',')
-            pby = section['data'].get('PBY', '').split(',')
-
-            try:
-                pbs = float(pbs)
-                pbw = [float(w) if w else 0.0 for w in pbw]
-                pby = [float(y) if y else 0.0 for y in pby]
-            except ValueError:
-                pbw, pby = [], []
-
-            if not pbw or not pby:
-                pitch_timeline.append((current_tick, 0.0))
-                current_tick += length
-                pitch_timeline.append((current_tick, 0.0))
-            else:
-                tick_offset = 0
-                for w, y in zip(pbw, pby):
-                    if w <= 0:
-                        continue
-                    tick_pos = current_tick + tick_offset
-                    pitch_timeline.append((tick_pos, y))
-                    tick_offset += w
-                pitch_timeline.append((current_tick + length, pby[-1] if pby else 0.0))
-                current_tick += length
+            ust_pitch.parse_note_curve(
+                current_tick, length,
+                notes.get(row, 'PBS', '0'), notes.get(row, 'PBW', ''), notes.get(row, 'PBY', ''),
+                ticks, cents
+            )
 
             # 颤音字段
-            vbr = section['data'].get('VBR', '')
+            vbr = notes.get(row, 'VBR', '')
             if vbr:
-                vibrato_data.append((current_tick - length, current_tick, vbr))
+                vibrato_data.append((current_tick, current_tick + length, vbr))
 
-        return pitch_timeline, vibrato_data
+        return ust_pitch.PitchTimeline.from_lists(ticks, cents), vibrato_data
 
-    def apply_pitch_and_vibrato_data(self, source_pitch_timeline, source_vibrato_data, source_total_ticks):
-        """将音高线和颤音映射到目标音符"""
+    def apply_pitch_and_vibrato_data(self, source_pitch_timeline, source_vibrato_data, source_total_ticks, task=None):
+        """
+        将音高线和颤音映射到目标音符；task 用于在工作线程中汇报进度（0.8~1.0）。
+        总长度不匹配时抛出 ValueError（在工作线程中调用，不弹窗）
+        """
         if not source_total_ticks or source_total_ticks != self.total_ticks:
-            messagebox.showerror("错误", "源文件与目标文件的总长度不匹配")
-            return False
-
-        for section in self.sections:
-            if section['type'] != 'number':
-                continue
-            length = int(section['data'].get('Length', '0'))
-            if length <= 0:
-                continue
-
-            start_tick = sum(int(s['data'].get('Length', '0')) for s in self.sections[:section['original_index']] if s['type'] == 'number')
-            end_tick = start_tick + length
-
-            # 音高映射
-            new_pbw = []
-            new_pby = []
-            prev_tick = start_tick
-            for tick, pitch in source_pitch_timeline:
-                if start_tick <= tick < end_tick:
-                    relative_tick = tick - start_tick
-                    width = relative_tick - sum(float(w) for w in new_pbw if w)
-                    if width > 0:
-                        new_pbw.append(str(width))
-                        new_pby.append(str(pitch))
-                    prev_tick = tick
-            if prev_tick < end_tick:
-                width = end_tick - prev_tick
-                if width > 0 and new_pby:
-                    new_pbw.append(str(width))
-                    new_pby.append(new_pby[-1])
-
-            if new_pbw and new_pby:
-                section['data']['PBS'] = '0'
-                section['data']['PBW'] = ','.join(new_pbw)
-                section['data']['PBY'] = ','.join(new_pby)
-            else:
-                section['data'].pop('PBS', None)
-                section['data'].pop('PBW', None)
-                section['data'].pop('PBY', None)
-
-            # 颤音映射
-            applied_vbr = None
-            for vbr_start, vbr_end, vbr in source_vibrato_data:
-                if start_tick < vbr_end and end_tick > vbr_start:  # 任意重叠
-                    applied_vbr = vbr
-                    break
-            if applied_vbr:
-                section['data']['VBR'] = applied_vbr
+            raise ValueError("源文件与目标文件的总长度不匹配")
+
+        if not isinstance(source_pitch_timeline, ust_pitch.PitchTimeline):
+            source_pitch_timeline = ust_pitch.PitchTimeline(source_pitch_timeline)
+        vibrato_index = ust_pitch.VibratoIndex(source_vibrato_data)
+        notes = self.notes
+        rows = [row for row, length in enumerate(notes.lengths) if length > 0]
+        starts = [notes.starts[row] for row in rows]
+        ends = [notes.starts[row] + notes.lengths[row] for row in rows]
+
+        # 音高映射：整条曲线一次切到各音符
+        curves = ust_pitch.resample(source_pitch_timeline, starts, ends)
+        for i, (row, start_tick, end_tick, curve) in enumerate(zip(rows, starts, ends, curves)):
+            if task is not None and i % 5000 == 0:
+                task.report(0.8 + 0.2 * i / len(rows), "映射音高与颤音...")
+            if curve:
+                notes.set(row, 'PBS', '0')
+                notes.set(row, 'PBW', curve[0])
+                notes.set(row, 'PBY', curve[1])
             else:
-                section['data'].pop('VBR', None)
+                notes.set(row, 'PBS', None)
+                notes.set(row, 'PBW', None)
+                notes.set(row, 'PBY', None)
+
+            # 颤音映射：与本音符重叠的第一个颤音
+            notes.set(row, 'VBR', vibrato_index.first_overlap(start_tick, end_tick) or None)
 
         return True
 
-    def save(self):
+    def save(self, path=None, changed_only=False):
         try:
-            with open(self.file_path, 'w', encoding='shift_jis', newline='\r\n', errors='replace') as f:
-                for section in self.sections:
-                    f.write(section['header'] + '\r\n')
-                    for k, v in section['data'].items():
-                        f.write('{0}={1}\r\n'.format(k, v))
+            ust_core.write_ust(path or self.file_path, self.notes.to_sections(), changed_only=changed_only)
             return True
         except Exception as e:
-            messagebox.showerror("保存错误", "文件保存失败：{0}".format(str(e)))
+            ust_core.messagebox().showerror("保存错误", "文件保存失败：{0}".format(str(e)))
             return False
 
 class PitchMapperInterface:
@@ -191,7 +146,8 @@ class PitchMapperInterface:
         self.file_label = ttk.Label(main_frame, text="未选择 .ust 文件")
         self.file_label.pack(fill='x', pady=5)
         ttk.Button(main_frame, text="选择文件", command=self._select_file).pack(pady=5)
-        ttk.Button(main_frame, text="应用音高和颤音映射", command=self._apply_mapping).pack(pady=10)
+        self.apply_button = ttk.Button(main_frame, text="应用音高和颤音映射", command=self._apply_mapping)
+        self.apply_button.pack(pady=10)
 
     def _select_file(self):
         file_path = filedialog.askopenfilename(
@@ -206,34 +162,87 @@ class PitchMapperInterface:
         if not self.selected_ust_path:
             messagebox.showerror("错误", "请先选择一个 .ust 文件")
             return
-
-        target_processor = UstProcessor(self.tmp_path, encoding='shift_jis')
-        if not target_processor.sections:
-            return
+        # 映射进行中不能再点一次，否则两次映射会同时保存
+        self.apply_button.config(state='disabled')
+        ust_gui.BackgroundTask(self.master, "音高与颤音映射", self._transfer, self._on_transferred,
+                               on_abort=self._enable_apply)
+
+    def _enable_apply(self):
+        self.apply_button.config(state='normal')
+
+    def _transfer(self, task):
+        """工作线程：读取两个文件并映射音高与颤音，返回处理好的目标文件（不操作界面）"""
+        task.report(0.0, "读取目标文件...")
+        target_processor = UstProcessor(self.tmp_path, parse=False)
+        with ust_profile.phase('parse_target'):
+            target_processor.load()
+        if not target_processor.notes:
+            raise ValueError("目标文件中没有音符")
         if not target_processor.is_mode2:
-            messagebox.showerror("错误", "目标文件未启用 Mode2，请在 UTAU 中启用 Mode2")
-            return
-
-        source_processor = UstProcessor(self.selected_ust_path, encoding='shift_jis')
-        if not source_processor.sections:
-            return
-        pitch_timeline, vibrato_data = source_processor.get_pitch_and_vibrato_data()
+            raise ValueError("目标文件未启用 Mode2，请在 UTAU 中启用 Mode2")
+
+        task.report(0.3, "读取来源文件...")
+        source_processor = UstProcessor(self.selected_ust_path, parse=False)
+        with ust_profile.phase('parse_source'):
+            source_processor.load()
+        if not source_processor.notes:
+            raise ValueError("来源文件中没有音符")
+
+        task.report(0.6, "提取音高与颤音...")
+        with ust_profile.phase('extract'):
+            pitch_timeline, vibrato_data = source_processor.get_pitch_and_vibrato_data()
         source_total_ticks = source_processor.total_ticks
-
-        if target_processor.apply_pitch_and_vibrato_data(pitch_timeline, vibrato_data, source_total_ticks):
-            if target_processor.save():
-                messagebox.showinfo("完成", "音高与颤音映射已完成")
-                self.master.destroy()
+        if not source_total_ticks or source_total_ticks != target_processor.total_ticks:
+            raise ValueError("源文件与目标文件的总长度不匹配：来源 {0}，目标 {1}".format(
+                source_processor.length_text(), target_processor.length_text()))
+
+        task.report(0.8, "映射音高与颤音...")
+        ust_profile.note(notes=len(target_processor.notes), source_notes=len(source_processor.notes))
+        with ust_profile.phase('apply'):
+            target_processor.apply_pitch_and_vibrato_data(pitch_timeline, vibrato_data, source_total_ticks, task)
+        task.report(1.0, "保存...")
+        return target_processor
+
+    def _on_transferred(self, target_processor):
+        with ust_profile.phase('save'):
+            saved = target_processor.save(changed_only=True)
+        if saved:
+            messagebox.showinfo("完成", "音高与颤音映射已完成")
+            self.master.destroy()
+        else:
+            self._enable_apply()
+
+def target_is_mode2(path):
+    """只读到第一个音符为止，检查目标文件是否启用了 Mode2（不用解析整个文件）"""
+    for section in ust_core.iter_sections(path):
+        if section.type == 'SETTING':
+            mode2 = section.get('Mode2')
+            if mode2 is not None:
+                return mode2.lower() == 'true'
+        elif section.type == 'number':
+            break
+    return False
 
 def main():
+    _import_tkinter()
     if len(sys.argv) < 2:
         messagebox.showerror("错误", "请通过UTAU插件菜单运行")
         return
 
     tmp_path = sys.argv[-1]
-    root = tk.Tk()
-    PitchMapperInterface(root, tmp_path)
-    root.mainloop()
+    # 目标文件不能用时直接提示，不必先打开窗口、选完来源文件才发现
+    try:
+        mode2 = target_is_mode2(tmp_path)
+    except Exception as e:
+        messagebox.showerror("解析错误", "文件解析失败：{0}".format(str(e)))
+        return
+    if not mode2:
+        messagebox.showerror("错误", "目标文件未启用 Mode2，请在 UTAU 中启用 Mode2")
+        return
+    with ust_profile.session('she4', tmp_path):
+        root = tk.Tk()
+        PitchMapperInterface(root, tmp_path)
+        root.mainloop()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
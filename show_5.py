@@ -2,55 +2,55 @@ import sys
 import os
 import tkinter as tk
 import tkinter.messagebox as messagebox
-from tkinter import ttk
+
+import ust_core
+import ust_gui
+
+ust_profile = ust_core.load_profile()
 
 class UstNoteParser:
     def __init__(self, file_path):
         self.file_path = file_path
         self.notes = []
-        self.tempo = 120.0  # 默认曲速
+        self.tempo = 120.0  # 开头的曲速
+        self.timeline = None
     
     def parse(self):
         """解析UST文件并提取音符信息"""
-        current_note = None
-        
         try:
-            with open(self.file_path, 'r', encoding='shift_jis') as f:
-                for line in f:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    
-                    # 处理节
-                    if line.startswith('[#'):
-                        if current_note:
-                            self.notes.append(current_note)
-                        current_note = self._new_note(line[2:-1])
-                    
-                    # 处理全局设置
-                    elif line.startswith('Tempo='):
-                        self.tempo = float(line.split('=')[1])
-                    
-                    # 处理音符参数
-                    elif current_note and '=' in line:
-                        key, value = line.split('=', 1)
-                        key = key.strip()
-                        value = value.strip()
-                        current_note['data'][key] = value
-            
-                if current_note:  # 添加最后一个音符
-                    self.notes.append(current_note)
-                
+            self.load()
         except Exception as e:
             messagebox.showerror("解析错误", str(e))
             return False
         
         return True
     
+    def load(self, task=None):
+        """解析UST文件，出错时抛出异常（不弹窗，可在工作线程中调用）；task 用于汇报进度"""
+        sections = ust_core.parse_ust(self.file_path, decode=True)  # 所有字段都要显示，一遍解码
+        row = 0
+        for i, section in enumerate(sections):
+            if task is not None and i % 5000 == 0:
+                task.report(float(i) / len(sections), "读取音符...")
+            # 处理音符参数（row 为时间轴中的音符行号）
+            current_note = self._new_note(section.name)
+            current_note['data'].update(section.data)
+            if section.type == 'number':
+                current_note['row'] = row
+                row += 1
+            self.notes.append(current_note)
+        if task is not None:
+            task.report(1.0, "计算时间轴...")
+        
+        # 中途变速时按分段曲速计算每个音符的时间
+        self.timeline = ust_core.Timeline.from_sections(sections)
+        self.tempo = self.timeline.tempos[0]
+    
     def _new_note(self, note_type):
         """创建新音符数据结构"""
         return {
             'type': note_type,
+            'row': None,
             'data': {
                 'Lyric': '',
                 'NoteNum': '60',
@@ -64,11 +64,12 @@ class UstNoteParser:
         }
 
 class NoteViewer:
-    def __init__(self, notes, tempo):
-        self.root = tk.Tk()
+    def __init__(self, notes, tempo, root=None, timeline=None):
+        self.root = root or tk.Tk()
         self.root.title("UTAU音符分析器")
         self.notes = notes
         self.tempo = tempo
+        self.timeline = timeline
         self._setup_ui()
     
     def _setup_ui(self):
@@ -80,18 +81,19 @@ class NoteViewer:
         info_frame = tk.LabelFrame(main_frame, text="全局设置")
         tk.Label(info_frame, text="曲速(BPM):").grid(row=0, column=0, sticky='e')
         tk.Label(info_frame, text=str(self.tempo)).grid(row=0, column=1, sticky='w')
+        if self.timeline is not None and len(self.timeline.tempos) > 1:
+            tk.Label(info_frame, text="（中途变速 {0} 次）".format(len(self.timeline.tempos) - 1)).grid(
+                row=0, column=2, sticky='w')
         info_frame.pack(fill='x', pady=5)
         
-        # 表格框架
-        tree_frame = tk.Frame(main_frame)
-        tree_frame.pack(fill='both', expand=True)
-        
-        # 创建表格
-        columns = ('type', 'lyric', 'notenum', 'length', 'preutt', 'velocity', 'flags')
-        self.tree = ttk.Treeview(tree_frame, columns=columns, show='headings')
+        # 表格：只创建可见的行，滚动时按需格式化，音符再多也能立刻显示
+        columns = ('type', 'start', 'lyric', 'notenum', 'length', 'preutt', 'velocity', 'flags')
+        self.view = ust_gui.VirtualTree(main_frame, columns, self._note_row)
+        self.tree = self.view.tree
         
         # 设置列标题
         self.tree.heading('type', text='类型')
+        self.tree.heading('start', text='开始时间')
         self.tree.heading('lyric', text='歌词')
         self.tree.heading('notenum', text='音高')
         self.tree.heading('length', text='长度')
@@ -101,6 +103,7 @@ class NoteViewer:
         
         # 设置列宽
         self.tree.column('type', width=80, anchor='center')
+        self.tree.column('start', width=80, anchor='center')
         self.tree.column('lyric', width=100, anchor='center')
         self.tree.column('notenum', width=60, anchor='center')
         self.tree.column('length', width=80, anchor='center')
@@ -108,32 +111,38 @@ class NoteViewer:
         self.tree.column('velocity', width=80, anchor='center')
         self.tree.column('flags', width=150, anchor='w')
         
-        # 添加滚动条
-        scrollbar = ttk.Scrollbar(tree_frame, orient="vertical", command=self.tree.yview)
-        self.tree.configure(yscrollcommand=scrollbar.set)
-        scrollbar.pack(side='right', fill='y')
-        self.tree.pack(side='left', fill='both', expand=True)
+        self.view.pack(fill='both', expand=True)
+        self.view.set_count(len(self.notes))
         
-        # 填充数据
-        for note in self.notes:
-            length_ticks = note['data'].get('Length', '480')
+        # 底部按钮
+        tk.Button(main_frame, text="退出", command=self.root.destroy).pack(pady=10)
+    
+    def _note_row(self, index):
+        """第 index 个音符在表格中的 (values, tags)"""
+        note = self.notes[index]
+        length_ticks = note['data'].get('Length', '480')
+        start = ''
+        if self.timeline is not None and note.get('row') is not None:
+            start_sec, end_sec = self.timeline.note_seconds(note['row'])
+            start = "{0:.2f}s".format(start_sec)
+            length_sec = end_sec - start_sec
+        else:
             try:
                 length_sec = (int(length_ticks)/480) * (60/self.tempo)
             except:
                 length_sec = 0.0
-            
-            self.tree.insert('', 'end', values=(
-                note['type'],
-                note['data'].get('Lyric', ''),
-                self._midi_to_note(int(note['data'].get('NoteNum', '60'))),
-                "{0}ticks ({1:.2f}s)".format(length_ticks, length_sec),
-                note['data'].get('PreUtterance', '自动'),
-                note['data'].get('Velocity', '100'),
-                note['data'].get('Flags', '无')
-            ))
         
-        # 底部按钮
-        tk.Button(main_frame, text="退出", command=self.root.destroy).pack(pady=10)
+        values = (
+            note['type'],
+            start,
+            note['data'].get('Lyric', ''),
+            self._midi_to_note(int(note['data'].get('NoteNum', '60'))),
+            "{0}ticks ({1:.2f}s)".format(length_ticks, length_sec),
+            note['data'].get('PreUtterance', '自动'),
+            note['data'].get('Velocity', '100'),
+            note['data'].get('Flags', '无')
+        )
+        return values, ()
     
     def _midi_to_note(self, midi_num):
         """将MIDI编号转换为音高表示（兼容Python 3.4）"""
@@ -155,14 +164,25 @@ def main():
         messagebox.showerror("错误", "文件不存在")
         return
     
-    # 解析文件
-    parser = UstNoteParser(file_path)
-    if not parser.parse():
-        return
-    
-    # 显示界面
-    viewer = NoteViewer(parser.notes, parser.tempo)
-    viewer.show()
+    # 在后台线程解析文件，完成后显示界面
+    with ust_profile.session('show_5', file_path):
+        root = tk.Tk()
+        root.withdraw()
+        parser = UstNoteParser(file_path)
+        
+        def work(task):
+            with ust_profile.phase('parse'):
+                parser.load(task)
+            ust_profile.note(sections=len(parser.notes))
+            return parser
+        
+        def done(parser):
+            root.deiconify()
+            with ust_profile.phase('viewer'):
+                NoteViewer(parser.notes, parser.tempo, root, parser.timeline)
+        
+        ust_gui.BackgroundTask(root, "读取中", work, done, on_abort=root.destroy)
+        root.mainloop()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
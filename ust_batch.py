@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+'''
+多进程批量处理 UST 文件（不需要 UTAU）。
+用法：
+    python ust_batch.py kua  -o 输出文件夹 [-j 进程数] 歌曲/*.ust
+    python ust_batch.py L_2  -o 输出文件夹 --multiplier 1.5 歌曲/*.ust
+    python ust_batch.py jun  -o 输出文件夹 歌曲/*.ust
+    python ust_batch.py she4 -o 输出文件夹 --source 音高来源.ust 歌曲/*.ust
+    python ust_batch.py preutt -o 输出文件夹 歌曲/*.ust    （把 PreUtterance 设为 0）
+kua、L_2、preutt 加 --stream 时逐节读写，不把整个文件放进内存
+'''
+import os
+import sys
+import glob
+import time
+import argparse
+import multiprocessing
+
+import ust_core
+
+OPERATIONS = ('kua', 'L_2', 'jun', 'she4', 'preutt')
+
+# 每个工作进程的数据（映射表、音高来源等），由主进程读好后传给各进程
+_worker_state = {}
+
+
+def load_state(operation, options):
+    """
+    在主进程里读取所有文件共用的数据（映射表、别名表、oto.ini 索引、音高来源），读不了时抛出异常。
+    放在建进程池之前：进程池的初始化函数出错时会不停地重启工作进程，imap 永远不返回
+    """
+    state = {'operation': operation, 'options': options}
+    if operation == 'kua':
+        import kua_mapping
+        state['mapping'] = kua_mapping.load_mapping(options['mapping'])
+        state['alias_table'] = (kua_mapping.AliasTable.load(options['aliases'])
+                                if options.get('aliases') else None)
+        if options.get('voice_dir'):
+            import ust_oto
+            state['oto'] = ust_oto.OtoIndex.load(options['voice_dir'], os.path.dirname(os.path.abspath(__file__)))
+        else:
+            state['oto'] = None
+    elif operation == 'she4':
+        import she4
+        source = she4.UstProcessor(options['source'], parse=False)
+        source.load()
+        state['source'] = (source.get_pitch_and_vibrato_data(), source.total_ticks)
+    return state
+
+
+def _init_worker(state):
+    _worker_state.clear()
+    _worker_state.update(state)
+
+
+def _run_kua(path, out_path, options):
+    import kua_mapping
+    if options['stream']:
+        splitter = kua_mapping.ProjectSplitter(
+            _worker_state['mapping'], overlap=options['overlap'], pre_utterance=options['pre_utterance'],
+            oto=_worker_state['oto'])
+        return ust_core.stream_transform(path, out_path, splitter)
+    sections, note_count = kua_mapping.split_project(
+        ust_core.parse_ust(path), _worker_state['mapping'],
+        overlap=options['overlap'], pre_utterance=options['pre_utterance'],
+        alias_table=_worker_state['alias_table'], oto=_worker_state['oto'])
+    ust_core.write_ust(out_path, sections)
+    return note_count
+
+
+def _run_l2(path, out_path, options):
+    import L_2
+    if options['stream']:
+        return ust_core.stream_transform(path, out_path, L_2.SectionScaler(options['multiplier']))
+    notes = ust_core.NoteTable(ust_core.parse_ust(path))
+    L_2.multiply_lengths(notes, options['multiplier'])
+    ust_core.write_ust(out_path, notes.to_sections())
+    return len(notes)
+
+
+def _run_jun(path, out_path, options):
+    import jun
+    notes = ust_core.NoteTable(ust_core.parse_ust(path))
+    if options['global_average']:
+        averaged = jun.average_lengths(notes)
+    else:
+        averaged = jun.average_phrases(notes, options['grid'])
+    if not averaged:
+        raise ValueError('没有有效的数字节长度')
+    ust_core.write_ust(out_path, notes.to_sections())
+    return len(notes)
+
+
+def _run_she4(path, out_path, options):
+    import she4
+    (pitch_timeline, vibrato_data), source_total_ticks = _worker_state['source']
+    target = she4.UstProcessor(path, parse=False)
+    target.load()
+    if not target.notes:
+        raise ValueError('文件中没有音符')
+    if source_total_ticks != target.total_ticks:
+        raise ValueError('源文件与目标文件的总长度不匹配')
+    target.apply_pitch_and_vibrato_data(pitch_timeline, vibrato_data, source_total_ticks)
+    ust_core.write_ust(out_path, target.notes.to_sections())
+    return len(target.notes)
+
+
+def _run_preutt(path, out_path, options):
+    import kua_mapping
+    if options['stream']:
+        return ust_core.stream_transform(path, out_path, kua_mapping.reset_pre_utterance)
+    sections = ust_core.parse_ust(path)
+    for section in sections:
+        kua_mapping.reset_pre_utterance(section)
+    ust_core.write_ust(out_path, sections)
+    return sum(1 for section in sections if section.type == 'number')
+
+
+_RUNNERS = {
+    'kua': _run_kua,
+    'L_2': _run_l2,
+    'jun': _run_jun,
+    'she4': _run_she4,
+    'preutt': _run_preutt,
+}
+
+
+def _process_one(job):
+    """工作进程中处理一个文件，返回 (路径, 音符数, 错误信息)"""
+    path, out_path = job
+    try:
+        runner = _RUNNERS[_worker_state['operation']]
+        return path, runner(path, out_path, _worker_state['options']), None
+    except Exception as e:
+        return path, 0, str(e) or e.__class__.__name__
+
+
+def run_batch(operation, jobs, options, workers=None, chunksize=None, report=None):
+    """
+    用进程池处理 jobs（[(输入路径, 输出路径), ...]），结果按输入顺序交给 report。
+    workers 为 1 时不启动进程池，直接在当前进程里处理。返回 (音符总数, 失败数)
+    """
+    workers = workers or multiprocessing.cpu_count()
+    if chunksize is None:
+        # 每个进程大约分到 4 块，文件多时减少进程间通信次数
+        chunksize = max(1, len(jobs) // (workers * 4))
+    total_notes = 0
+    failed = 0
+    try:
+        state = load_state(operation, options)
+    except Exception as e:
+        # 共用的数据读不了时每个文件都做不了，逐个报告同一个错误
+        error = str(e) or e.__class__.__name__
+        for path, _ in jobs:
+            if report:
+                report(path, 0, error)
+        return 0, len(jobs)
+    if workers == 1:
+        _init_worker(state)
+        results = map(_process_one, jobs)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers, _init_worker, (state,))
+        results = pool.imap(_process_one, jobs, chunksize)
+    try:
+        for path, note_count, error in results:
+            if error:
+                failed += 1
+            else:
+                total_notes += note_count
+            if report:
+                report(path, note_count, error)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return total_notes, failed
+
+
+def expand_inputs(patterns):
+    paths = []
+    for pattern in patterns:
+        matched = sorted(glob.glob(pattern))
+        paths.extend(matched if matched else [pattern])
+    return paths
+
+
+def main(argv=None):
+    plugin_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='多进程批量处理 UST 文件')
+    parser.add_argument('operation', choices=OPERATIONS, help='要执行的处理')
+    parser.add_argument('inputs', nargs='+', help='UST 文件或通配符')
+    parser.add_argument('-o', '--output', required=True, help='输出文件夹')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='进程数（默认 CPU 核数）')
+    parser.add_argument('--chunksize', type=int, default=None, help='每次分给一个进程的文件数')
+    parser.add_argument('--stream', action='store_true', help='kua/L_2/preutt：逐节流式读写，内存占用固定')
+    parser.add_argument('--mapping', default=os.path.join(plugin_dir, 'pinyin.txt'), help='kua：映射表路径')
+    parser.add_argument('--no-overlap', action='store_true', help='kua：不设置衔接处80ms的overlap')
+    parser.add_argument('--pre-utterance-zero', action='store_true', help='kua：设置PreUtterance为0')
+    parser.add_argument('--aliases', nargs='?', const=os.path.join(plugin_dir, 'aaaaa.txt'),
+                        help='kua：连续音模式，按别名表（默认aaaaa.txt）连接，不能与 --stream 同时使用')
+    parser.add_argument('--voice-dir', help='kua：音源文件夹，按其中的oto.ini选方案并使用真实的先行发声/重叠')
+    parser.add_argument('--multiplier', type=float, default=2.0, help='L_2：长度倍率')
+    parser.add_argument('--grid', type=int, default=0, help='jun：量化网格（tick），0 为不量化')
+    parser.add_argument('--global-average', action='store_true', help='jun：不分句，所有音符统一为全局平均值')
+    parser.add_argument('--source', help='she4：音高与颤音来源 .ust 文件')
+    args = parser.parse_args(argv)
+
+    if args.operation == 'she4' and not args.source:
+        parser.error('she4 需要 --source')
+    if args.aliases and args.stream:
+        parser.error('--aliases 不能与 --stream 同时使用')
+    options = {
+        'mapping': args.mapping,
+        'overlap': not args.no_overlap,
+        'pre_utterance': args.pre_utterance_zero,
+        'aliases': args.aliases,
+        'voice_dir': args.voice_dir,
+        'multiplier': args.multiplier,
+        'grid': args.grid,
+        'global_average': args.global_average,
+        'source': args.source,
+        'stream': args.stream,
+    }
+    paths = expand_inputs(args.inputs)
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    jobs = [(path, os.path.join(args.output, os.path.basename(path))) for path in paths]
+
+    def report(path, note_count, error):
+        if error:
+            print("{0}: 失败：{1}".format(path, error))
+        else:
+            print("{0}: {1} 个音符".format(path, note_count))
+
+    start = time.perf_counter()
+    total_notes, failed = run_batch(args.operation, jobs, options, args.jobs, args.chunksize, report)
+    elapsed = time.perf_counter() - start
+    print("共 {0} 个文件（失败 {1}），{2} 个音符，用时 {3:.2f} 秒，{4:.0f} 音符/秒".format(
+        len(jobs), failed, total_notes, elapsed, total_notes / elapsed if elapsed else 0))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,666 @@
+# -*- coding: utf-8 -*-
+'''
+UST 文件解析/保存公共模块，供 kua_3_fix.py、kua_3.py、L_2.py、jun.py、she4.py、show_5.py 共用。
+使用时请把本文件和插件放在同一个文件夹里。
+'''
+import os
+import re
+import codecs
+from array import array
+from bisect import bisect_right
+
+NAMED_SECTION_TYPES = ('PREV', 'NEXT', 'SETTING')
+
+DEFAULT_ENCODING = 'cp932'  # UTAU 的 Shift-JIS 实际是 Windows 的 cp932
+ERRORS = 'ust'              # 无法解码的字节原样保留，写回时还原，不丢数据
+
+_CHARSET_RE = re.compile(br'(?m)^Charset=([A-Za-z0-9_.:-]+)')
+_NON_ASCII_RE = re.compile(br'[\x80-\xff]')
+_SNIFF_SIZE = 4096
+_CHUNK_SIZE = 65536
+
+
+def _ust_error_handler(exc):
+    # 解码：坏字节变成代理字符；编码：代理字符还原成原字节，编码表里没有的字符写成 '?'
+    if isinstance(exc, UnicodeEncodeError):
+        chunk = exc.object[exc.start:exc.end]
+        if all('\udc80' <= c <= '\udcff' for c in chunk):
+            return bytes(ord(c) - 0xdc00 for c in chunk), exc.end
+        return '?' * len(chunk), exc.end
+    return codecs.lookup_error('surrogateescape')(exc)
+
+
+codecs.register_error(ERRORS, _ust_error_handler)
+
+
+def _normalize_encoding(name):
+    try:
+        name = codecs.lookup(name).name
+    except LookupError:
+        return None
+    return DEFAULT_ENCODING if name == 'shift_jis' else name
+
+
+def detect_encoding(path):
+    """
+    判断 UST 的编码，通常只需读开头一小段：BOM > Charset= 行 > 第一个含非 ASCII 字节的行是否为合法 UTF-8，
+    都判断不了时用 cp932
+    """
+    with open(path, 'rb') as f:
+        head = f.read(_SNIFF_SIZE)
+        if head.startswith(codecs.BOM_UTF8):
+            return 'utf-8-sig'
+        match = _CHARSET_RE.search(head)
+        if match:
+            encoding = _normalize_encoding(match.group(1).decode('ascii'))
+            if encoding:
+                return encoding
+        chunk = head
+        while chunk:
+            match = _NON_ASCII_RE.search(chunk)
+            if match is None:
+                chunk = f.read(_CHUNK_SIZE)
+                continue
+            pos = match.start()
+            # 只检查第一个非 ASCII 字节所在的这一行
+            end = chunk.find(b'\n', pos)
+            decoder = codecs.getincrementaldecoder('utf-8')()
+            try:
+                decoder.decode(chunk[pos:end if end >= 0 else len(chunk)], final=end >= 0)
+            except UnicodeDecodeError:
+                return DEFAULT_ENCODING
+            return 'utf-8'
+    return DEFAULT_ENCODING
+
+
+class SectionList(list):
+    """UstSection 列表，额外记住文件的编码，写回时沿用"""
+
+    def __init__(self, sections=(), encoding=None):
+        list.__init__(self, sections)
+        self.encoding = encoding
+
+
+def get_section_type(header):
+    """根据节头判断类型：'number'、'PREV'、'NEXT'、'SETTING' 或 'other'"""
+    end = header.find(']', 2)
+    if end < 0:
+        return 'other'
+    name = header[2:end]
+    if name.isdigit():
+        return 'number'
+    if name in NAMED_SECTION_TYPES:
+        return name
+    return 'other'
+
+
+def _decode_lines(lines):
+    data = {}
+    for line in lines:
+        key, sep, value = line.partition('=')
+        if sep:
+            data[key.strip()] = value.strip()
+    return data
+
+
+class UstSection(object):
+    """
+    UST 中的一节。键值行在第一次访问 data 时才解码成字典。
+    从文件读入的节记住原始行，用于判断是否被修改过（dirty）
+    """
+    __slots__ = ('header', 'type', 'original_index', '_lines', '_data', '_source')
+
+    def __init__(self, header, section_type=None, data=None, original_index=None, lines=None, clean=False):
+        self.header = header
+        self.type = section_type if section_type is not None else get_section_type(header)
+        self.original_index = original_index
+        self._lines = lines if lines is not None else []
+        self._data = data
+        self._source = self._lines if clean and data is None else None
+
+    @property
+    def name(self):
+        """节头中的名字，如 '0012'、'SETTING'"""
+        return self.header[2:-1]
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = _decode_lines(self._lines)
+            self._lines = None
+        return self._data
+
+    @property
+    def dirty(self):
+        """新建的节，或内容与读入时不同的节"""
+        if self._source is None:
+            return True
+        if self._data is None:
+            return False
+        return self._data != _decode_lines(self._source)
+
+    def get(self, key, default=None):
+        """读取单个字段，未解码时直接扫描原始行，不构建字典"""
+        if self._data is not None:
+            return self._data.get(key, default)
+        prefix = key + '='
+        value = default
+        for line in self._lines:
+            if line.startswith(prefix):
+                value = line[len(prefix):].strip()
+        return value
+
+    def lines(self):
+        """返回要写回文件的 key=value 行"""
+        if self._data is None:
+            return self._lines
+        return ['{0}={1}'.format(k, v) for k, v in self._data.items()]
+
+
+MISSING = -2147483648  # 数组中表示"该音符没有这个字段（或不是整数）"
+TICKS_PER_BEAT = 480
+DEFAULT_TEMPO = 120.0
+REST_LYRICS = ('R', 'r', '')  # 休止符的歌词
+# NoteTable 旁表中 Length/NoteNum 行原来所在的位置，写回时换成数组里的值，各字段保持原来的顺序
+_LENGTH_SLOT = '\0Length'
+_NOTENUM_SLOT = '\0NoteNum'
+
+
+def is_rest(lyric):
+    return lyric is None or lyric.strip() in REST_LYRICS
+
+
+def note_starts(lengths):
+    """各音符的起始 tick（前缀和，负长度按 0 计），返回 (starts, 总 tick 数)"""
+    starts = array('q', bytes(8 * len(lengths)))
+    tick = 0
+    for i, length in enumerate(lengths):
+        starts[i] = tick
+        if length > 0:
+            tick += length
+    return starts, tick
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return MISSING
+
+
+class NoteTable(object):
+    """
+    数字节的列式存储：Length/NoteNum/起始 tick 放在整数数组里，
+    其余字段按原始 key=value 行放在旁表 extras 中（Length/NoteNum 的位置留一个占位），非数字节原样保留
+    """
+    __slots__ = ('layout', 'headers', 'lengths', 'notenums', 'starts', 'extras', 'encoding', '_raw_rows',
+                 '_original')
+
+    def __init__(self, sections):
+        self.encoding = getattr(sections, 'encoding', None)
+        self.layout = []            # 非数字节为 UstSection，数字节为 None（按顺序对应各行）
+        self.headers = []
+        self.lengths = array('i')
+        self.notenums = array('i')
+        self.extras = []
+        self._raw_rows = set()      # Length/NoteNum 不是整数、原样留在 extras 里的行
+        pool = {}                   # 相同的行（Intensity=100、Flags= 等）只保留一份
+        for section in sections:
+            if section.type != 'number':
+                self.layout.append(section)
+                continue
+            self.layout.append(None)
+            self._add_row(section, pool)
+        self.update_starts()
+        # 读入时的快照，用于判断哪些音符被改过（extras 里是共享的元组，复制列表很便宜）
+        self._original = (array('i', self.lengths), array('i', self.notenums), list(self.extras))
+
+    def _add_row(self, section, pool):
+        row = len(self.headers)
+        length = notenum = MISSING
+        rest = []
+        lines = section._lines if section._data is None else section.lines()
+        for line in lines:
+            if line.startswith('Length='):
+                length = _to_int(line[7:])
+                if length == MISSING:
+                    rest.append(line)
+                    self._raw_rows.add(row)
+                else:
+                    rest.append(_LENGTH_SLOT)
+            elif line.startswith('NoteNum='):
+                notenum = _to_int(line[8:])
+                if notenum == MISSING:
+                    rest.append(line)
+                    self._raw_rows.add(row)
+                else:
+                    rest.append(_NOTENUM_SLOT)
+            else:
+                rest.append(pool.setdefault(line, line))
+        self.headers.append(section.header)
+        self.lengths.append(length)
+        self.notenums.append(notenum)
+        rest = tuple(rest)
+        self.extras.append(pool.setdefault(rest, rest))
+
+    def __len__(self):
+        return len(self.headers)
+
+    def update_starts(self):
+        """重新计算每个音符的起始 tick（前缀和），修改 lengths 后调用"""
+        self.starts, tick = note_starts(self.lengths)
+        return tick
+
+    def total_ticks(self):
+        return sum(length for length in self.lengths if length > 0)
+
+    def timeline(self):
+        """由本表建立时间轴（与本表共用 starts，修改长度后需重新建立）"""
+        base_tempo = None
+        for section in self.layout:
+            if section is not None and section.type == 'SETTING':
+                base_tempo = parse_tempo(section.get('Tempo')) or base_tempo
+        changes = []
+        # 先在所有不同的行里找出 Tempo 行，再用集合运算找带 Tempo 的音符，不逐行比较字符串
+        tempo_lines = set(line for line in set().union(*self.extras) if line.startswith('Tempo='))
+        if tempo_lines:
+            for row, extras in enumerate(self.extras):
+                if not tempo_lines.isdisjoint(extras):
+                    tempo = parse_tempo(self.get(row, 'Tempo'))
+                    if tempo:
+                        changes.append((row, tempo))
+        return Timeline(self.lengths, self.starts, changes, base_tempo)
+
+    def matching_rows(self, key, test):
+        """
+        旁表字段值满足 test(value) 的行号列表（没有该字段时 value 为 None）。
+        每种不同的行只判断一次，再用集合运算找出各行，不逐行比较字符串
+        """
+        prefix = key + '='
+        keyed = set(line for line in set().union(*self.extras) if line.startswith(prefix))
+        hits = set(line for line in keyed if test(line[len(prefix):].strip()))
+        missing = test(None)
+        rows = []
+        for row, extras in enumerate(self.extras):
+            if not hits.isdisjoint(extras):
+                rows.append(row)
+            elif missing and keyed.isdisjoint(extras):
+                rows.append(row)
+        return rows
+
+    def get(self, row, key, default=None):
+        """读取旁表中的字段"""
+        prefix = key + '='
+        value = default
+        for line in self.extras[row]:
+            if line.startswith(prefix):
+                value = line[len(prefix):].strip()
+        return value
+
+    def set(self, row, key, value):
+        """写入旁表中的字段（已有时在原位置替换，没有时加在最后），value 为 None 时删除该字段"""
+        prefix = key + '='
+        lines = []
+        placed = value is None
+        for line in self.extras[row]:
+            if line.startswith(prefix):
+                if not placed:
+                    lines.append(prefix + value)
+                    placed = True
+                continue
+            lines.append(line)
+        if not placed:
+            lines.append(prefix + value)
+        self.extras[row] = tuple(lines)
+
+    def is_dirty(self, row):
+        """该音符的 Length/NoteNum/其余字段是否与读入时不同"""
+        lengths, notenums, extras = self._original
+        if row >= len(lengths):
+            return True
+        return (self.lengths[row] != lengths[row] or self.notenums[row] != notenums[row] or
+                self.extras[row] != extras[row])
+
+    def row_lines(self, row):
+        """返回某个音符要写回文件的 key=value 行，各字段保持读入时的顺序"""
+        length = self.lengths[row]
+        notenum = self.notenums[row]
+        length_line = None if length == MISSING else 'Length={0}'.format(length)
+        notenum_line = None if notenum == MISSING else 'NoteNum={0}'.format(notenum)
+        raw = row in self._raw_rows  # 原来的值不是整数、后来才改成整数时，在原来那一行的位置写出
+        lines = []
+        for line in self.extras[row]:
+            if line == _LENGTH_SLOT or (raw and length_line and line.startswith('Length=')):
+                if length_line:
+                    lines.append(length_line)
+                    length_line = None
+            elif line == _NOTENUM_SLOT or (raw and notenum_line and line.startswith('NoteNum=')):
+                if notenum_line:
+                    lines.append(notenum_line)
+                    notenum_line = None
+            else:
+                lines.append(line)
+        # 原来没有、后来才设置的放在最前面
+        head = [line for line in (length_line, notenum_line) if line]
+        return head + lines if head else lines
+
+    def to_sections(self):
+        """还原成 UstSection 列表，用于 write_ust"""
+        sections = SectionList(encoding=self.encoding)
+        row = 0
+        for section in self.layout:
+            if section is None:
+                section = UstSection(self.headers[row], 'number', lines=self.row_lines(row),
+                                     clean=not self.is_dirty(row))
+                row += 1
+            section.original_index = len(sections)
+            sections.append(section)
+        return sections
+
+
+def parse_tempo(value):
+    """把 Tempo 字段转成正的浮点数，无效时返回 None"""
+    try:
+        tempo = float(value)
+    except (TypeError, ValueError):
+        return None
+    return tempo if tempo > 0 else None
+
+
+class Timeline(object):
+    """
+    工程的时间轴：音符起始 tick（前缀和）加分段曲速表，tick 与秒互相换算、按秒找音符都是 O(log n)。
+    曲速从 [#SETTING] 的 Tempo 开始（没有时用第一个带 Tempo 的音符或 120），音符上的 Tempo 从该音符开始生效。
+    行号只计数字节
+    """
+    __slots__ = ('starts', 'lengths', 'tempo_ticks', 'tempos', 'tempo_seconds')
+
+    def __init__(self, lengths, starts, tempo_changes=(), base_tempo=None):
+        """lengths 为各音符长度，starts 为 note_starts() 算好的起始 tick，tempo_changes 为 (行号, 曲速)"""
+        self.lengths = lengths
+        self.starts = starts
+        tempo_changes = sorted(tempo_changes)
+        if base_tempo is None:
+            base_tempo = tempo_changes[0][1] if tempo_changes else DEFAULT_TEMPO
+        self.tempo_ticks = [0]
+        self.tempos = [float(base_tempo)]
+        for row, tempo in tempo_changes:
+            tick = starts[row]
+            if tick == self.tempo_ticks[-1]:
+                self.tempos[-1] = float(tempo)
+            elif tempo != self.tempos[-1]:
+                self.tempo_ticks.append(tick)
+                self.tempos.append(float(tempo))
+        # 每段曲速开始时的秒数（前缀和）
+        self.tempo_seconds = [0.0]
+        for i in range(1, len(self.tempo_ticks)):
+            self.tempo_seconds.append(self.tempo_seconds[-1] + (self.tempo_ticks[i] - self.tempo_ticks[i - 1]) *
+                                      60.0 / (self.tempos[i - 1] * TICKS_PER_BEAT))
+
+    @classmethod
+    def from_sections(cls, sections):
+        lengths = array('i')
+        changes = []
+        base_tempo = None
+        for section in sections:
+            if section.type == 'SETTING':
+                base_tempo = parse_tempo(section.get('Tempo')) or base_tempo
+            elif section.type == 'number':
+                tempo = parse_tempo(section.get('Tempo'))
+                if tempo:
+                    changes.append((len(lengths), tempo))
+                length = _to_int(section.get('Length', '0'))
+                lengths.append(length if length > 0 else 0)
+        return cls(lengths, note_starts(lengths)[0], changes, base_tempo)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def total_ticks(self):
+        if not len(self.starts):
+            return 0
+        return self.starts[-1] + max(self.lengths[-1], 0)
+
+    def tempo_at(self, tick):
+        return self.tempos[max(bisect_right(self.tempo_ticks, tick) - 1, 0)]
+
+    def note_tempo(self, row):
+        """第 row 个音符开始时生效的曲速"""
+        return self.tempo_at(self.starts[row])
+
+    def seconds(self, tick):
+        """tick 位置对应的秒数"""
+        i = max(bisect_right(self.tempo_ticks, tick) - 1, 0)
+        return self.tempo_seconds[i] + (tick - self.tempo_ticks[i]) * 60.0 / (self.tempos[i] * TICKS_PER_BEAT)
+
+    def tick_at(self, seconds):
+        """秒数对应的 tick 位置（浮点数）"""
+        i = max(bisect_right(self.tempo_seconds, seconds) - 1, 0)
+        return self.tempo_ticks[i] + (seconds - self.tempo_seconds[i]) * self.tempos[i] * TICKS_PER_BEAT / 60.0
+
+    def note_seconds(self, row):
+        """第 row 个音符的 (开始秒数, 结束秒数)"""
+        start = self.starts[row]
+        return self.seconds(start), self.seconds(start + max(self.lengths[row], 0))
+
+    def note_at(self, tick):
+        """tick 所在的音符行号，不在任何音符内时返回 None"""
+        row = bisect_right(self.starts, tick) - 1
+        if row < 0 or tick >= self.starts[row] + max(self.lengths[row], 0):
+            return None
+        return row
+
+    def note_at_seconds(self, seconds):
+        return self.note_at(self.tick_at(seconds))
+
+
+def iter_parse_lines(lines):
+    """把文本行逐节解析成 UstSection（单次遍历，不使用正则），每读完一节就交出去"""
+    current = None
+    lines_of_current = None
+    index = 0
+    for line in lines:
+        if line[:2] != '[#':
+            if line[:1].isspace():
+                line = line.strip()
+            if line[:2] != '[#':
+                # 没有 '=' 的行（如 UST Version1.2）也原样保留，解码时跳过
+                if lines_of_current is not None and line:
+                    lines_of_current.append(line)
+                continue
+        if current is not None:
+            yield current
+        header = line.strip()
+        lines_of_current = []
+        current = UstSection(header, get_section_type(header),
+                             original_index=index, lines=lines_of_current, clean=True)
+        index += 1
+    if current is not None:
+        yield current
+
+
+def iter_decoded_lines(lines):
+    """
+    与 iter_parse_lines 相同，但在同一遍里直接把键值行解码成字典（要用到所有字段时比先存行再解码快）。
+    这样得到的节不记原始行，dirty 总是为真
+    """
+    current = None
+    data = None
+    index = 0
+    for line in lines:
+        # 绝大多数行是 key=value，先按 '=' 拆开，节头不含 '='
+        key, sep, value = line.partition('=')
+        if sep:
+            if data is not None:
+                data[key.strip()] = value.strip()
+            continue
+        header = line.strip()
+        if header[:2] != '[#':
+            continue
+        if current is not None:
+            yield current
+        data = {}
+        current = UstSection(header, get_section_type(header), data=data, original_index=index)
+        index += 1
+    if current is not None:
+        yield current
+
+
+def parse_lines(lines, encoding=None, decode=False):
+    """把文本行解析成 UstSection 列表，decode 为真时同时解码所有字段"""
+    return SectionList(iter_decoded_lines(lines) if decode else iter_parse_lines(lines), encoding)
+
+
+def parse_ust(path, encoding=None, errors=ERRORS, decode=False):
+    """
+    读取并解析 UST 文件，encoding 为 None 时自动判断，结果的 .encoding 为实际使用的编码。
+    decode 为真时一遍读完所有字段（只读、要用到全部字段的插件如 show_5 用），否则字段在访问时才解码。
+    出错时直接抛出异常，由插件自行提示
+    """
+    encoding = encoding or detect_encoding(path)
+    with open(path, 'r', encoding=encoding, errors=errors) as f:
+        text = f.read()
+    return parse_lines(text.splitlines(), encoding, decode)
+
+
+def iter_sections(path, encoding=None, errors=ERRORS):
+    """流式读取 UST：逐节生成 UstSection，内存里只保留当前一节"""
+    encoding = encoding or detect_encoding(path)
+    with open(path, 'r', encoding=encoding, errors=errors) as f:
+        for section in iter_parse_lines(line.rstrip('\r\n') for line in f):
+            yield section
+
+
+def _section_text(section, changed_only=False):
+    out = [section.header]
+    # 只写改动时，没改过的音符只写节头：UTAU 按节头定位，[#INSERT]/[#DELETE] 的位置不变
+    if not (changed_only and section.type == 'number' and not section.dirty):
+        out.extend(section.lines())
+    out.append('')
+    return '\r\n'.join(out)
+
+
+class UstWriter(object):
+    """逐节写出 UST（CRLF 换行），配合 iter_sections 做流式处理"""
+
+    def __init__(self, path, encoding=None, errors=ERRORS):
+        self.encoding = encoding or DEFAULT_ENCODING
+        self._file = open(path, 'w', encoding=self.encoding, newline='', errors=errors)
+
+    def write(self, section):
+        self._file.write(_section_text(section))
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def stream_transform(in_path, out_path, transform, encoding=None, errors=ERRORS):
+    """
+    流式处理：transform(section) 返回一节、若干节的列表或 None（删除该节）。
+    out_path 与 in_path 相同时先写临时文件再替换。返回处理的音符数
+    """
+    same_file = os.path.abspath(in_path) == os.path.abspath(out_path)
+    target = out_path + '.tmp' if same_file else out_path
+    note_count = 0
+    encoding = encoding or detect_encoding(in_path)
+    try:
+        with UstWriter(target, encoding, errors) as writer:
+            for section in iter_sections(in_path, encoding, errors):
+                if section.type == 'number':
+                    note_count += 1
+                result = transform(section)
+                if result is None:
+                    continue
+                if isinstance(result, UstSection):
+                    result = (result,)
+                for new_section in result:
+                    writer.write(new_section)
+        if same_file:
+            os.replace(target, out_path)
+    except Exception:
+        if same_file and os.path.exists(target):
+            os.remove(target)
+        raise
+    return note_count
+
+
+def write_ust(path, sections, encoding=None, errors=ERRORS, changed_only=False):
+    """
+    把节列表写回 UST 文件（CRLF 换行），encoding 为 None 时沿用 sections.encoding。
+    changed_only 为真时（插件写回 UTAU 用）没改过的音符只写节头，PREV/NEXT 等非数字节照常写出
+    """
+    encoding = encoding or getattr(sections, 'encoding', None) or DEFAULT_ENCODING
+    with open(path, 'w', encoding=encoding, newline='', errors=errors) as f:
+        f.write(''.join(_section_text(section, changed_only) for section in sections))
+
+
+def save_cache(path, data):
+    """
+    写插件的缓存/记录文件：先写临时文件再替换，不会留下写了一半的文件。
+    临时文件名每次不同，几个插件同时写同一个文件时不会互相覆盖临时文件。
+    data 为 bytes 时按二进制写，为 str 时按 UTF-8 写。插件目录只读时不写，返回 False，插件照常使用
+    """
+    import tempfile  # 只在写缓存时才用到，不拖慢各插件的启动
+    try:
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(path) + '.',
+                                        dir=os.path.dirname(path) or '.')
+    except OSError:
+        return False
+    try:
+        if isinstance(data, bytes):
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+        else:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+def messagebox():
+    """tkinter.messagebox，只在需要弹窗时才导入 tkinter（导入要十几毫秒，L_2、jun 正常运行时用不到）"""
+    import tkinter.messagebox
+    return tkinter.messagebox
+
+
+class _NullProfile(object):
+    """没有 ust_profile.py 时的替身：phase()、session() 返回什么都不做的 with 块，note() 忽略"""
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def stop(self):
+        pass
+
+    def phase(self, name):
+        return self
+
+    def session(self, plugin, ust_path=None):
+        return self
+
+    def note(self, **info):
+        pass
+
+
+def load_profile():
+    """插件用的分阶段计时模块 ust_profile；插件文件夹里没有 ust_profile.py 时返回不计时的替身，插件照常运行"""
+    try:
+        import ust_profile
+    except ImportError:
+        return _NullProfile()
+    return ust_profile
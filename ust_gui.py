@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+'''
+插件共用的界面组件，供 kua_3_fix.py、show_5.py 使用。
+VirtualTree：表格只创建一屏的行，滚动时把可见范围的数据换上去，几万个音符也能立刻打开。
+BackgroundTask：在工作线程里读取/处理文件，显示进度条，可以取消，界面不会卡住。
+'''
+import queue
+import threading
+import tkinter as tk
+import tkinter.messagebox as messagebox
+from tkinter import ttk
+
+
+class VirtualTree(object):
+    """
+    虚拟表格：ttk.Treeview 里只有"一屏"的行，第 index 行的内容由 row(index) 返回 (values, tags)。
+    总行数用 set_count 设置，可以一边后台填充一边增加
+    """
+
+    def __init__(self, master, columns, row, height=20, selectmode='none'):
+        self.frame = tk.Frame(master)
+        self.tree = ttk.Treeview(self.frame, columns=columns, show='headings', height=height, selectmode=selectmode)
+        self.scrollbar = ttk.Scrollbar(self.frame, orient='vertical', command=self._on_scrollbar)
+        self.scrollbar.pack(side='right', fill='y')
+        self.tree.pack(side='left', fill='both', expand=True)
+        self.row = row
+        self.count = 0
+        self.first = 0          # 第一可见行对应的数据行号
+        self._shown_first = 0
+        self.items = []         # Treeview 中实际存在的行（一屏）
+        self.on_scroll = None   # 可见范围改变时调用（如关闭正在编辑的下拉框）
+        self._resize(height)
+        self.tree.bind('<Configure>', self._on_configure)
+        self.tree.bind('<MouseWheel>', self._on_wheel)
+        self.tree.bind('<Button-4>', lambda event: self.scroll(-3))
+        self.tree.bind('<Button-5>', lambda event: self.scroll(3))
+
+    def pack(self, **kwargs):
+        self.frame.pack(**kwargs)
+
+    def set_count(self, count):
+        self.count = count
+        self.refresh()
+
+    def index_of(self, item):
+        """Treeview 行 id 对应的数据行号，空行返回 None"""
+        if item not in self.items:
+            return None
+        index = self.first + self.items.index(item)
+        return index if index < self.count else None
+
+    def refresh_row(self, index):
+        """数据行 index 改变后调用，只在可见时更新"""
+        k = index - self.first
+        if 0 <= k < len(self.items) and index < self.count:
+            values, tags = self.row(index)
+            self.tree.item(self.items[k], values=values, tags=tags)
+
+    def scroll(self, rows):
+        self.first += rows
+        self.refresh()
+
+    def refresh(self):
+        first = max(0, min(self.first, self.count - len(self.items)))
+        moved = first != self._shown_first
+        self.first = self._shown_first = first
+        for k, item in enumerate(self.items):
+            index = first + k
+            if index < self.count:
+                values, tags = self.row(index)
+            else:
+                values, tags = (), ()
+            self.tree.item(item, values=values, tags=tags)
+        if self.count:
+            self.scrollbar.set(float(first) / self.count, min(1.0, float(first + len(self.items)) / self.count))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+        if moved and self.on_scroll:
+            self.on_scroll()
+
+    def _resize(self, visible):
+        visible = max(1, visible)
+        if visible == len(self.items):
+            return
+        while len(self.items) < visible:
+            self.items.append(self.tree.insert('', 'end'))
+        while len(self.items) > visible:
+            self.tree.delete(self.items.pop())
+        self.refresh()
+
+    def _on_configure(self, event):
+        # 用第一行的位置和高度算出窗口里能放下几行
+        bbox = self.tree.bbox(self.items[0]) if self.items else None
+        if not bbox or bbox[3] <= 0:
+            return
+        self._resize((event.height - bbox[1]) // bbox[3])
+
+    def _on_scrollbar(self, *args):
+        if args[0] == 'moveto':
+            self.first = int(float(args[1]) * self.count)
+        elif args[0] == 'scroll':
+            step = len(self.items) if args[2] == 'pages' else 1
+            self.first += int(args[1]) * step
+        self.refresh()
+
+    def _on_wheel(self, event):
+        self.scroll(-3 if event.delta > 0 else 3)
+
+
+class Cancelled(Exception):
+    """用户点了"取消"，由 BackgroundTask.report 在工作线程中抛出"""
+
+
+class BackgroundTask(object):
+    """
+    在工作线程里执行 work(task)，界面上显示进度条和"取消"按钮。
+    work 中调用 task.report(进度, 说明) 汇报进度（0~1），用户取消后 report 会抛出 Cancelled。
+    写文件等不能中途停下的步骤前调用 task.commit(说明)，之后不能再取消（写完了就一定调用 on_done）。
+    work 不能操作界面；结果、错误和进度都经队列交回 Tk 主线程：
+    完成时调用 on_done(结果)，出错（弹窗提示后）或取消时调用 on_abort()。
+    取消后即使 work 已经算完也不再调用 on_done。进度窗口是模态的，运行期间不能再点主窗口的按钮
+    """
+    POLL_MS = 50
+
+    def __init__(self, master, title, work, on_done, on_abort=None):
+        self.master = master
+        self.work = work
+        self.on_done = on_done
+        self.on_abort = on_abort
+        self._queue = queue.Queue()
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()  # 保证 cancel() 与 commit() 只有一个生效
+        self._committed = False
+
+        self.window = tk.Toplevel(master)
+        self.window.title(title)
+        self.window.resizable(False, False)
+        self.window.protocol('WM_DELETE_WINDOW', self.cancel)
+        frame = tk.Frame(self.window, padx=10, pady=10)
+        frame.pack(fill='both', expand=True)
+        self.label = ttk.Label(frame, text=title, width=40)
+        self.label.pack(fill='x', pady=5)
+        self.bar = ttk.Progressbar(frame, length=300, maximum=1.0, mode='determinate')
+        self.bar.pack(fill='x', pady=5)
+        self.cancel_button = ttk.Button(frame, text="取消", command=self.cancel)
+        self.cancel_button.pack(pady=5)
+        self._make_modal()
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True  # 关掉窗口时不等工作线程
+        self._thread.start()
+        self.master.after(self.POLL_MS, self._poll)
+
+    # 以下三个方法在工作线程中调用
+    def report(self, fraction, text=None):
+        if self._cancel.is_set():
+            raise Cancelled()
+        self._queue.put(('progress', fraction, text))
+
+    def commit(self, text=None):
+        with self._lock:
+            if self._cancel.is_set():
+                raise Cancelled()
+            self._committed = True
+        self._queue.put(('commit', None, text))
+
+    def _run(self):
+        try:
+            result = self.work(self)
+        except Cancelled:
+            self._queue.put(('cancelled', None, None))
+        except Exception as e:
+            self._queue.put(('error', e, None))
+        else:
+            self._queue.put(('done', result, None))
+
+    # 以下方法在 Tk 主线程中调用
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def cancel(self):
+        with self._lock:
+            if self._committed:
+                return  # 已经在写文件，不能取消
+            self._cancel.set()
+        self.cancel_button.config(state='disabled')
+        self.label.config(text="正在取消...")
+
+    def _make_modal(self):
+        # 主窗口隐藏时（读取阶段）不设 transient，否则有的窗口管理器连进度窗口也一起隐藏
+        if self.master.winfo_viewable():
+            self.window.transient(self.master)
+        try:
+            self.window.wait_visibility()
+            self.window.grab_set()
+        except tk.TclError:
+            pass  # 抓不到输入焦点时照常运行，只是不是模态
+
+    def _poll(self):
+        try:
+            while True:
+                kind, value, text = self._queue.get_nowait()
+                if kind == 'progress':
+                    self.bar['value'] = value
+                    if text:
+                        self.label.config(text=text)
+                    continue
+                if kind == 'commit':
+                    self.cancel_button.config(state='disabled')
+                    if text:
+                        self.label.config(text=text)
+                    continue
+                self.window.destroy()
+                if kind == 'done' and not self._cancel.is_set():
+                    self.on_done(value)
+                    return
+                if kind == 'error':
+                    messagebox.showerror("错误", str(value) or value.__class__.__name__)
+                if self.on_abort:
+                    self.on_abort()
+                return
+        except queue.Empty:
+            pass
+        self.master.after(self.POLL_MS, self._poll)
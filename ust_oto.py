@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+'''
+音源 oto.ini 的别名索引，供 kua_3_fix.py 在拆音时检查音源里有没有对应的音、取真实的先行发声/重叠。
+会读取音源文件夹（含子文件夹）里所有的 oto.ini；索引缓存在插件目录，oto.ini 没变时直接读缓存。
+'''
+import os
+import hashlib
+import marshal
+
+import ust_core
+
+CACHE_VERSION = 1
+
+
+def resolve_voice_dir(sections, ust_path, plugin_dir):
+    """
+    从 [#SETTING] 的 VoiceDir 得到音源文件夹。%VOICE% 指 UTAU 安装目录下的 voice 文件夹
+    （插件在 UTAU/plugins/插件名/ 中），相对路径相对于 UST 所在文件夹。找不到时返回 None
+    """
+    voice_dir = None
+    for section in sections:
+        if section.type == 'SETTING':
+            voice_dir = section.get('VoiceDir') or voice_dir
+    if not voice_dir:
+        return None
+    if '%VOICE%' in voice_dir:
+        utau_dir = os.path.dirname(os.path.dirname(os.path.abspath(plugin_dir)))
+        voice_dir = voice_dir.replace('%VOICE%', os.path.join(utau_dir, 'voice') + os.sep)
+    voice_dir = voice_dir.replace('\\', os.sep)
+    if not os.path.isabs(voice_dir):
+        voice_dir = os.path.join(os.path.dirname(os.path.abspath(ust_path)), voice_dir)
+    return voice_dir if os.path.isdir(voice_dir) else None
+
+
+def parse_oto_lines(lines, entries):
+    """把 oto.ini 的行加进 {别名: (先行发声, 重叠)}，同一别名以先出现的为准"""
+    for line in lines:
+        filename, sep, params = line.partition('=')
+        if not sep:
+            continue
+        fields = params.split(',')
+        alias = fields[0].strip() or os.path.splitext(filename.strip())[0]
+        if alias in entries:
+            continue
+        preutterance = fields[4].strip() if len(fields) > 4 else ''
+        overlap = fields[5].strip() if len(fields) > 5 else ''
+        entries[alias] = (preutterance, overlap)
+
+
+def _scan(voice_dir):
+    """返回 (各文件夹的修改时间, 各 oto.ini 的 (路径, 修改时间, 大小))"""
+    dirs = []
+    otos = []
+    for root, _, files in os.walk(voice_dir):
+        dirs.append((root, os.stat(root).st_mtime_ns))
+        if 'oto.ini' in files:
+            path = os.path.join(root, 'oto.ini')
+            st = os.stat(path)
+            otos.append((path, st.st_mtime_ns, st.st_size))
+    return dirs, otos
+
+
+def _unchanged(dirs, otos):
+    try:
+        for path, mtime in dirs:
+            if os.stat(path).st_mtime_ns != mtime:
+                return False
+        for path, mtime, size in otos:
+            st = os.stat(path)
+            if st.st_mtime_ns != mtime or st.st_size != size:
+                return False
+    except OSError:
+        return False
+    return True
+
+
+class OtoIndex(object):
+    """音源的别名索引：alias in index、index.get(alias) -> (先行发声, 重叠)（字符串，可能为空）"""
+
+    def __init__(self, entries):
+        self.entries = entries
+
+    def __contains__(self, alias):
+        return alias in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, alias):
+        return self.entries.get(alias)
+
+    def missing(self, option):
+        """方案中音源里没有的音"""
+        return [roma for _, roma in option if roma not in self.entries]
+
+    def first_available(self, options):
+        """第一个所有音都存在的方案，都不完整时返回第一个方案"""
+        for option in options:
+            if not self.missing(option):
+                return option
+        return options[0]
+
+    @classmethod
+    def load(cls, voice_dir, cache_dir=None):
+        """
+        读取音源文件夹里所有的 oto.ini。给出 cache_dir 时缓存索引：
+        所有文件夹和 oto.ini 的修改时间都没变时直接读缓存
+        """
+        cache_path = None
+        if cache_dir:
+            digest = hashlib.sha1(os.path.abspath(voice_dir).encode('utf-8', 'surrogateescape')).hexdigest()
+            cache_path = os.path.join(cache_dir, 'oto_{0}.cache'.format(digest[:16]))
+            try:
+                with open(cache_path, 'rb') as f:
+                    version, dirs, otos, entries = marshal.loads(f.read())
+                if version == (CACHE_VERSION, marshal.version) and _unchanged(dirs, otos):
+                    return cls(entries)
+            except (OSError, EOFError, ValueError, TypeError):
+                pass
+
+        dirs, otos = _scan(voice_dir)
+        entries = {}
+        for path, _, _ in otos:
+            encoding = ust_core.detect_encoding(path)
+            with open(path, 'r', encoding=encoding, errors='replace') as f:
+                parse_oto_lines(f.read().splitlines(), entries)
+        if cache_path:
+            ust_core.save_cache(cache_path, marshal.dumps(((CACHE_VERSION, marshal.version), dirs, otos, entries)))
+        return cls(entries)
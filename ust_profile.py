@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+'''
+插件运行的分阶段计时（可选，默认关闭）。
+设置环境变量 UST_PROFILE=1，或在插件文件夹里放一个名为 ust_profile.on 的空文件即可开启：
+每次运行结束后，把各阶段（读取、处理、填表、保存等）的用时、CPU 时间和内存峰值作为一行 JSON
+追加到插件文件夹的 ust_profile.jsonl。开启时用 tracemalloc 统计内存，插件会变慢一些，用完请关掉。
+python ust_profile.py [ust_profile.jsonl] 汇总各插件各阶段的用时。
+'''
+import os
+import sys
+import time
+import threading
+import contextlib
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+LOG_PATH = os.path.join(PLUGIN_DIR, 'ust_profile.jsonl')
+FLAG_PATH = os.path.join(PLUGIN_DIR, 'ust_profile.on')
+ENV_VAR = 'UST_PROFILE'
+
+_run = None  # 当前进程正在记录的运行，未开启时为 None
+
+
+def enabled():
+    return os.environ.get(ENV_VAR, '') not in ('', '0') or os.path.exists(FLAG_PATH)
+
+
+class _NullPhase(object):
+    """未开启时 phase() 返回的空阶段，什么都不做"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def stop(self):
+        pass
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class Phase(object):
+    """
+    一个阶段：创建时开始计时，stop() 或 with 块结束时记录。
+    可以跨越多次 after() 回调（如分批填表），在最后一批时再 stop()
+    """
+
+    def __init__(self, run, name):
+        self.run = run
+        self.name = name
+        self._stopped = False
+        self.peak = 0  # 本阶段期间的内存峰值（绝对值），由 Run 在重置全局峰值前更新
+        self._memory = run.open_phase(self)
+        self._cpu = time.process_time()
+        self._wall = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    def stop(self):
+        if self._stopped:
+            return
+        self._stopped = True
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        self.run.close_phase(self)
+        self.run.phases.append({
+            'name': self.name,
+            'wall': round(wall, 6),
+            'cpu': round(cpu, 6),
+            'peak_kb': round(max(self.peak - self._memory, 0) / 1024.0, 1),
+        })
+
+
+class Run(object):
+    """一次插件运行的记录"""
+
+    def __init__(self, plugin, ust_path=None):
+        import tracemalloc
+        self.plugin = plugin
+        self.ust_path = ust_path
+        self.phases = []
+        self.info = {}
+        self.peak = 0
+        self._open = []  # 还没结束的阶段（可以嵌套，也可以在不同线程里重叠）
+        self._lock = threading.Lock()
+        tracemalloc.start()
+        self._cpu = time.process_time()
+        self._wall = time.perf_counter()
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def _collect_peak(self):
+        # tracemalloc 只有一个全局峰值：先把它记到所有未结束的阶段上
+        import tracemalloc
+        current, peak = tracemalloc.get_traced_memory()
+        for phase in self._open:
+            phase.peak = max(phase.peak, peak)
+        self.peak = max(self.peak, peak)
+        return current
+
+    def open_phase(self, phase):
+        """
+        开始一个阶段，返回当前内存用量。Python 3.9 以上会重置全局峰值，让新阶段单独算峰值；
+        重置前已把峰值记到外层阶段上，外层的峰值不受影响。更早的版本只能得到运行开始以来的峰值
+        """
+        import tracemalloc
+        with self._lock:
+            current = self._collect_peak()
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            phase.peak = current
+            self._open.append(phase)
+        return current
+
+    def close_phase(self, phase):
+        with self._lock:
+            self._collect_peak()
+            self._open.remove(phase)
+
+    def record(self, status):
+        import platform
+        import tracemalloc
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        record = {
+            'plugin': self.plugin,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'status': status,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'wall': round(wall, 6),
+            'cpu': round(cpu, 6),
+            'peak_kb': round(max(self.peak, tracemalloc.get_traced_memory()[1]) / 1024.0, 1),
+            'phases': self.phases,
+        }
+        if self.ust_path:
+            try:
+                record['ust_kb'] = round(os.path.getsize(self.ust_path) / 1024.0, 1)
+            except OSError:
+                pass
+        record.update(self.info)
+        tracemalloc.stop()
+        return record
+
+
+def phase(name):
+    """开始一个阶段：with ust_profile.phase('parse'): ...，未开启时不做任何事"""
+    if _run is None:
+        return _NULL_PHASE
+    return _run.phase(name)
+
+
+def note(**info):
+    """给本次运行附加信息（如音符数），未开启时忽略"""
+    if _run is not None:
+        _run.info.update(info)
+
+
+def start(plugin, ust_path=None):
+    global _run
+    if enabled():
+        _run = Run(plugin, ust_path)
+    return _run
+
+
+def finish(status='ok', log_path=None):
+    """结束记录并追加到日志，写不了日志时不影响插件"""
+    global _run
+    if _run is None:
+        return None
+    import json
+    record = _run.record(status)
+    _run = None
+    try:
+        with open(log_path or LOG_PATH, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False, sort_keys=True) + '\n')
+    except OSError:
+        pass
+    return record
+
+
+@contextlib.contextmanager
+def session(plugin, ust_path=None):
+    """with ust_profile.session('L_2', ust_path): ... 包住插件的 main，出异常时记为 error"""
+    start(plugin, ust_path)
+    status = 'ok'
+    try:
+        yield _run
+    except SystemExit:
+        raise
+    except BaseException as e:
+        status = 'error: {0}'.format(e.__class__.__name__)
+        raise
+    finally:
+        finish(status)
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(log_path=LOG_PATH):
+    """按 (插件, 阶段) 汇总：次数、用时中位数/90%、CPU 中位数、内存峰值最大值"""
+    import json
+    groups = {}
+    with open(log_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            for item in record.get('phases', []) + [dict(record, name='(total)')]:
+                groups.setdefault((record.get('plugin'), item['name']), []).append(item)
+    print('{0:<10} {1:<14} {2:>5} {3:>10} {4:>10} {5:>10} {6:>10}'.format(
+        'plugin', 'phase', 'runs', 'wall p50', 'wall p90', 'cpu p50', 'peak max'))
+    for (plugin, name), items in sorted(groups.items(), key=lambda item: (str(item[0][0]), str(item[0][1]))):
+        walls = [item['wall'] for item in items]
+        print('{0:<10} {1:<14} {2:>5} {3:>8.1f}ms {4:>8.1f}ms {5:>8.1f}ms {6:>8.0f}KB'.format(
+            plugin, name, len(items), _percentile(walls, 0.5) * 1000, _percentile(walls, 0.9) * 1000,
+            _percentile([item['cpu'] for item in items], 0.5) * 1000,
+            max(item.get('peak_kb', 0) for item in items)))
+    return groups
+
+
+if __name__ == '__main__':
+    summarize(sys.argv[1] if len(sys.argv) > 1 else LOG_PATH)
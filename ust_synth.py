@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+'''
+生成合成 UST 文件，用于性能测试（bench_ust.py）和不开 UTAU 时试用插件。
+同一个种子总是生成同一个文件。可以调整音符数、Mode2 音高点密度、颤音比例、变速间隔、休止符比例，
+歌词默认取自 pinyin.txt 的拼音。
+用法：python ust_synth.py -n 10000 [--seed 1] [--pitch-points 3] [--vibrato 0.2] [--tempo-every 200] 输出.ust
+'''
+import os
+import sys
+import random
+import argparse
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_LYRICS = ('a', 'ai', 'ba', 'xiao', 'jiu', 'ni', 'hao', 'wo', 'de')
+LENGTHS = (120, 240, 480, 960)
+
+
+def mapping_lyrics(mapping_path=None):
+    """映射表里的所有拼音（默认 pinyin.txt），读不到时返回内置的几个拼音"""
+    import kua_mapping
+    try:
+        lyrics = sorted(kua_mapping.load_mapping(mapping_path or os.path.join(PLUGIN_DIR, 'pinyin.txt')))
+    except (IOError, OSError):
+        return list(DEFAULT_LYRICS)
+    return lyrics or list(DEFAULT_LYRICS)
+
+
+def _pitch_lines(rnd, length, points):
+    """Mode2 音高：points 个点，宽度之和不超过音符长度"""
+    widths = []
+    left = length
+    for i in range(points):
+        width = rnd.randint(1, max(1, left // (points - i)))
+        widths.append(width)
+        left -= width
+    pitches = ['{0:.1f}'.format(rnd.uniform(-20, 20)) for _ in range(points)]
+    return ['PBS={0};{1:.1f}'.format(-rnd.randint(10, 60), rnd.uniform(-10, 10)),
+            'PBW=' + ','.join(str(w) for w in widths),
+            'PBY=' + ','.join(pitches)]
+
+
+def make_ust_lines(note_count, seed=0, lyrics=DEFAULT_LYRICS, pitch_points=3, vibrato=0.0, tempo_every=0,
+                   rest=0.1, tempo=120.0):
+    """
+    生成 UST 的各行。pitch_points 为每个音符的音高点数（0 为不写音高），vibrato 为带 VBR 的音符比例，
+    tempo_every 为每隔多少个音符变一次速（0 为不变速），rest 为休止符 R 的比例
+    """
+    rnd = random.Random(seed)
+    lines = ['[#VERSION]', 'UST Version1.2', '[#SETTING]', 'Tempo={0:.2f}'.format(tempo),
+             'Tracks=1', 'ProjectName=synth{0}'.format(seed), 'VoiceDir=%VOICE%uta',
+             'Mode2={0}'.format('True' if pitch_points else 'False')]
+    for i in range(note_count):
+        length = rnd.choice(LENGTHS)
+        lines.append('[#{0:04d}]'.format(i))
+        lines.append('Length={0}'.format(length))
+        lines.append('Lyric={0}'.format('R' if rnd.random() < rest else rnd.choice(lyrics)))
+        lines.append('NoteNum={0}'.format(rnd.randint(55, 72)))
+        if tempo_every and i and i % tempo_every == 0:
+            lines.append('Tempo={0:.2f}'.format(rnd.randint(80, 180)))
+        lines.append('PreUtterance=')
+        lines.append('Intensity=100')
+        lines.append('Modulation=0')
+        if pitch_points:
+            lines.extend(_pitch_lines(rnd, length, pitch_points))
+        if vibrato and rnd.random() < vibrato:
+            lines.append('VBR={0},{1},{2},20,20,0,0,0'.format(
+                rnd.randint(30, 80), rnd.randint(150, 200), rnd.randint(20, 40)))
+        lines.append('Flags=')
+    lines.append('[#TRACKEND]')
+    return lines
+
+
+def make_ust_text(note_count, seed=0, **options):
+    """生成 UST 文本（CRLF 换行），参数同 make_ust_lines"""
+    return '\r\n'.join(make_ust_lines(note_count, seed, **options)) + '\r\n'
+
+
+def write_ust(path, note_count, seed=0, encoding='cp932', **options):
+    with open(path, 'w', encoding=encoding, newline='') as f:
+        f.write(make_ust_text(note_count, seed, **options))
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='生成合成 UST 文件')
+    parser.add_argument('output', help='输出的 .ust 文件')
+    parser.add_argument('-n', '--notes', type=int, default=1000, help='音符数')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子')
+    parser.add_argument('--pitch-points', type=int, default=3, help='每个音符的 Mode2 音高点数（0 为不写音高）')
+    parser.add_argument('--vibrato', type=float, default=0.0, help='带颤音的音符比例（0~1）')
+    parser.add_argument('--tempo-every', type=int, default=0, help='每隔多少个音符变一次速（0 为不变速）')
+    parser.add_argument('--rest', type=float, default=0.1, help='休止符的比例（0~1）')
+    parser.add_argument('--mapping', default=None, help='歌词取自的映射表（默认 pinyin.txt）')
+    args = parser.parse_args(argv)
+    write_ust(args.output, args.notes, args.seed, lyrics=mapping_lyrics(args.mapping),
+              pitch_points=args.pitch_points, vibrato=args.vibrato, tempo_every=args.tempo_every, rest=args.rest)
+    print("已生成 {0}（{1} 个音符）".format(args.output, args.notes))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())